@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+import argparse
+import contextlib
+import hashlib
+import http.server
+import importlib.util
+import json
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+"""
+Description: Benchmarks a full dod-stack.py launch, ssh_env -> stack_up -> clean_up, against local stand-ins
+             for the environment and vpn urls (http server), the docker daemon (unix socket), and ssh, tmux and
+             dotenv/tmuxp (fake binaries on PATH), with a temporary $DOD_ROOT, HOME and config.
+             Latency and failures can be injected per service, p50/p95 are reported end to end and per phase.
+Usage Example:
+    python bench/bench_launch.py -n 20
+    python bench/bench_launch.py -n 50 --latency http=40 docker=5 ssh=150 tmux=20 --fail http=0.05
+    python bench/bench_launch.py --env dev2 prp1 --warm --json > bench_output.txt
+    python bench/bench_launch.py --latency tmux=200 --launcher tmuxp
+"""
+
+SERVICES = ('http', 'docker', 'redis', 'ssh', 'tmux')
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dod-stack.py')
+
+FAKE_SSH = r'''#!{python}
+# fake ssh: -fN forks a daemon named ssh that listens on the ports in BENCH_SSH_PORTS_<host>, -O check reports it
+import os, random, socket, sys, time
+args = sys.argv[1:]
+host = args[-1]
+control_path = next((a.split('=', 1)[1] for a in args if a.startswith('ControlPath=')), None)
+pid_file = f'{{control_path}}.bench-pid'
+time.sleep(float(os.environ.get('BENCH_LATENCY_SSH', 0)) / 1000)
+if '-O' in args:
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        print('Control socket connect: No such file or directory', file=sys.stderr)
+        sys.exit(255)
+    print(f'Master running (pid={{pid}})', file=sys.stderr)
+    sys.exit(0)
+if random.random() < float(os.environ.get('BENCH_FAIL_SSH', 0)):
+    print(f'ssh: connect to host {{host}} port 22: Connection refused', file=sys.stderr)
+    sys.exit(255)
+ports = [int(p) for p in os.environ.get(f'BENCH_SSH_PORTS_{{host}}', '').split(',') if p]
+if os.fork() == 0:
+    os.setsid()
+    if os.fork() == 0:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        daemon = ('import os, socket, sys, time\n'
+                  'listeners = []\n'
+                  'for port in {{ports}}:\n'
+                  '    s = socket.socket(); s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)\n'
+                  '    s.bind(("127.0.0.1", port)); s.listen(); listeners.append(s)\n'
+                  'open({{pid_file!r}}, "w").write(str(os.getpid()))\n'
+                  'time.sleep(3600)\n').format(ports=ports, pid_file=pid_file)
+        os.execv(sys.executable, ['ssh', '-c', daemon] + args)
+    os._exit(0)
+deadline = time.time() + 5
+while not os.path.exists(pid_file) and time.time() < deadline:
+    time.sleep(0.002)
+'''
+
+FAKE_TMUX = r'''#!{python}
+# fake tmux: the DOD_Stack session is a file holding one byte per pane, opening a window or pane takes the latency
+import os, random, sys, time
+session = os.environ['BENCH_TMUX_SESSION']
+command = sys.argv[1] if len(sys.argv) > 1 else ''
+if command == 'has-session':
+    sys.exit(0 if os.path.exists(session) else 1)
+if command == 'kill-session':
+    if os.path.exists(session):
+        os.remove(session)
+    sys.exit(0)
+if command == 'new-session':
+    open(session, 'w').close()
+elif command in ('new-window', 'split-window'):
+    time.sleep(float(os.environ.get('BENCH_LATENCY_TMUX', 0)) / 1000)
+    if random.random() < float(os.environ.get('BENCH_FAIL_TMUX', 0)):
+        sys.exit('fake tmux failure')
+    with open(session, 'a') as f:
+        f.write('.')
+        pane = f.tell()
+    print(f'@{{pane}} %{{pane}}' if command == 'new-window' else f'%{{pane}}')
+elif command == 'display-message':
+    print('sleep')
+sys.exit(0)
+'''
+
+FAKE_DOTENV = r'''#!{python}
+# fake dotenv -e .env tmuxp load dod-stack.yaml: the tmux session opens and is closed straight away
+import os, random, sys, time
+time.sleep(float(os.environ.get('BENCH_LATENCY_TMUX', 0)) / 1000)
+sys.exit(1 if random.random() < float(os.environ.get('BENCH_FAIL_TMUX', 0)) else 0)
+'''
+
+
+class Faults:
+    """
+    Latency in ms and failure rate from 0 to 1 injected per service
+    """
+
+    def __init__(self, latency: Dict[str, float], failure: Dict[str, float]):
+        self.latency = latency
+        self.failure = failure
+
+    def delay(self, service: str):
+        if self.latency.get(service):
+            time.sleep(self.latency[service] / 1000)
+
+    def fails(self, service: str) -> bool:
+        return random.random() < self.failure.get(service, 0)
+
+    def env(self) -> Dict[str, str]:
+        """
+        :rtype: Dict[str, str]
+        :return: variables the fake binaries read their faults from
+        """
+        variables = {}
+        for service in ('ssh', 'tmux'):
+            variables[f'BENCH_LATENCY_{service.upper()}'] = str(self.latency.get(service, 0))
+            variables[f'BENCH_FAIL_{service.upper()}'] = str(self.failure.get(service, 0))
+        return variables
+
+
+class FakeHttpHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the environment and vpn probes, 503 on an injected failure
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        faults = self.server.faults
+        faults.delay('http')
+        self.send_response(503 if faults.fails('http') else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_HEAD = do_GET = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Answers PING with LOADING until the redis latency has passed since the container started, then PONG
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip().upper().startswith(b'PING'):
+                self.wfile.write(b'-ERR unknown command\r\n')
+            elif time.perf_counter() < self.server.ready_at:
+                self.wfile.write(b'-LOADING Redis is loading the dataset in memory\r\n')
+            else:
+                self.wfile.write(b'+PONG\r\n')
+
+
+class FakeRedis:
+    """
+    Listens on the redis port only while the fake container runs
+    """
+
+    def __init__(self, port: int, faults: Faults):
+        self.port = port
+        self.faults = faults
+        self.server: Optional[socketserver.ThreadingTCPServer] = None
+
+    def start(self):
+        if self.server is None:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(('127.0.0.1', self.port), FakeRedisHandler)
+            self.server.daemon_threads = True
+            self.server.ready_at = time.perf_counter() + self.faults.latency.get('redis', 0) / 1000
+            threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The part of the docker engine api dod-stack.py uses: list, create, start and remove containers,
+    inspect and pull images
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self) -> str:
+        return 'docker.sock'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body=None, stream: bool = False):
+        if stream:  # like the daemon's pull progress, one json object per line
+            data = ''.join(f'{json.dumps(event)}\r\n' for event in body).encode()
+        else:
+            data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        faults, state = self.server.faults, self.server.state
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        faults.delay('docker')
+        if faults.fails('docker'):
+            return self._reply(500, {'message': 'injected failure'})
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        with state['lock']:
+            containers, images = state['containers'], state['images']
+            if self.command == 'GET' and url.path.endswith('/containers/json'):
+                filters = json.loads(query.get('filters', ['{}'])[0])
+                found = [container for name, container in containers.items()
+                         if all(re.search(pattern, f'/{name}') for pattern in filters.get('name', []))
+                         and all(container['Labels'].get(label.split('=')[0]) == label.partition('=')[2]
+                                 for label in filters.get('label', []))]
+                return self._reply(200, found)
+            if self.command == 'GET' and '/images/' in url.path and url.path.endswith('/json'):
+                image = urllib.parse.unquote(url.path.split('/images/', 1)[1][:-len('/json')])
+                if image not in images:
+                    return self._reply(404, {'message': f'No such image: {image}'})
+                return self._reply(200, {'Id': images[image], 'RepoTags': [image]})
+            if self.command == 'POST' and url.path.endswith('/images/create'):
+                image = f'{query["fromImage"][0]}:{query["tag"][0]}'
+                images[image] = f'sha256:{hashlib.sha256(image.encode()).hexdigest()}'
+                return self._reply(200, [{'status': f'Pulling from library/{query["fromImage"][0]}'},
+                                         {'status': 'Pull complete', 'id': 'bench'},
+                                         {'status': f'Downloaded newer image for {image}'}], stream=True)
+            if self.command == 'POST' and url.path.endswith('/containers/create'):
+                if body['Image'] not in images and body['Image'] not in images.values():
+                    return self._reply(404, {'message': f'No such image: {body["Image"]}'})
+                name = query['name'][0]
+                containers[name] = {'Id': f'bench-{name}', 'Names': [f'/{name}'], 'State': 'created',
+                                    'Labels': body.get('Labels') or {}}
+                return self._reply(201, {'Id': f'bench-{name}'})
+            target = next((name for name, container in containers.items()
+                           if urllib.parse.unquote(parts[-2 if self.command == 'POST' else -1]) in (name, container['Id'])),
+                          None)
+            if target is None:
+                return self._reply(404, {'message': 'No such container'})
+            if self.command == 'POST' and url.path.endswith('/start'):
+                containers[target]['State'] = 'running'
+                self.server.redis.start()
+                return self._reply(204)
+            if self.command == 'DELETE':
+                del containers[target]
+                self.server.redis.stop()
+                return self._reply(204)
+        self._reply(404, {'message': 'page not found'})
+
+    do_GET = do_POST = do_DELETE = _handle
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Sandbox:
+    """
+    Temporary HOME, $DOD_ROOT, config and PATH with the fakes running, one per benchmark
+    """
+
+    def __init__(self, env_names: List[str], faults: Faults, launcher: str = 'panes'):
+        self.root = tempfile.mkdtemp(prefix='dod-stack-bench-')
+        self.faults = faults
+        self.launcher = launcher
+        self.env_names = env_names
+        self.http = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeHttpHandler)
+        self.http.faults = faults
+        self.docker_socket = os.path.join(self.root, 'docker.sock')
+        self.docker = UnixServer(self.docker_socket, FakeDockerHandler)
+        self.docker.faults = faults
+        self.docker.state = {'lock': threading.Lock(), 'containers': {}, 'images': {}}
+        self.redis = FakeRedis(Sandbox.free_port(), faults)
+        self.docker.redis = self.redis
+        for server in (self.http, self.docker):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.ports = {env_name: Sandbox.free_port() for env_name in env_names}
+        self.config_path = os.path.join(self.root, 'config', 'config.json')
+        self.run_dir = os.path.join(self.root, 'run')
+        self._saved_env = dict(os.environ)
+        self._write_files()
+
+    @staticmethod
+    def free_port() -> int:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def _write(self, path: str, content: str, mode: int = 0o644):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, mode)
+
+    def _write_files(self):
+        url = f'http://127.0.0.1:{self.http.server_port}'
+        with open(os.path.join(os.path.dirname(SCRIPT), 'dod-stack-config', 'config.json')) as f:
+            config = json.load(f)
+        config.update(vpn_url=url, environments={env_name: url for env_name in config['environments']},
+                      docker_socket=self.docker_socket, run_dir=self.run_dir)
+        config['redis'] = dict(config.get('redis', {}), port=self.redis.port)
+        config['watchdog'] = dict(config.get('watchdog', {}), enabled=False)  # the fake stack closes at once
+        config['launcher'] = dict(config.get('launcher', {}), mode=self.launcher, services={
+            'api': {'depends_on': ['redis', 'tunnel'], 'ready': {'url': url}},
+            'worker': {'depends_on': ['api']},
+            'ui': {'depends_on': ['api']},
+        })
+        self._write('config/config.json', json.dumps(config, indent=4))
+        self._write('home/.ssh/config', ''.join(
+            f'Host {env_name}\n    HostName 127.0.0.1\n    LocalForward {port} 127.0.0.1:5432\n\n'
+            for env_name, port in self.ports.items()), 0o600)
+        self._write('home/.pgpass', ''.join(f'localhost:{port}:*:bench:bench\n' for port in self.ports.values()), 0o600)
+        self._write('dod/dod-stack/.env', f'DATABASE_PORT_OPS_DOD_MART={self.ports[self.env_names[0]]}\n')
+        self._write('dod/dod-stack/dod-stack.yaml', 'session_name: DOD_Stack\nwindows:\n' + ''.join(
+            f'  - window_name: {name}\n    panes:\n' + f'      - sleep 3600\n' * panes
+            for name, panes in (('api', 2), ('worker', 1), ('ui', 1))))
+        for name, source in (('ssh', FAKE_SSH), ('tmux', FAKE_TMUX), ('dotenv', FAKE_DOTENV)):
+            self._write(f'bin/{name}', source.format(python=sys.executable), 0o755)
+
+    def __enter__(self):
+        os.environ.update(self.faults.env())
+        os.environ.update({f'BENCH_SSH_PORTS_{env_name}': str(port) for env_name, port in self.ports.items()})
+        os.environ.update(BENCH_TMUX_SESSION=os.path.join(self.root, 'tmux-session'),
+                          HOME=os.path.join(self.root, 'home'), DOD_ROOT=os.path.join(self.root, 'dod'),
+                          PATH=f'{os.path.join(self.root, "bin")}{os.pathsep}{os.environ.get("PATH", "")}')
+        os.environ.pop('DOCKER_HOST', None)
+        for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+            os.environ.pop(name, None)  # the stand-ins are local, a proxy would only add its own latency
+        return self
+
+    def reset(self, warm: bool):
+        """
+        forgets the check cache, unless warm, and kills tunnels an iteration left behind
+        :rtype: void
+        """
+        if not warm:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(os.path.dirname(self.config_path), '.check-cache.json'))
+        for pid_file in os.listdir(self.run_dir) if os.path.isdir(self.run_dir) else []:
+            if pid_file.endswith('.bench-pid'):
+                with contextlib.suppress(OSError, ValueError):
+                    with open(os.path.join(self.run_dir, pid_file)) as f:
+                        os.kill(int(f.read()), signal.SIGTERM)
+
+    def __exit__(self, *exc):
+        self.reset(warm=False)
+        os.environ.clear()
+        os.environ.update(self._saved_env)
+        self.http.shutdown()
+        self.docker.shutdown()
+        self.redis.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def load_dod_stack():
+    """
+    imports dod-stack.py, the dash in its name rules out a plain import
+    """
+    spec = importlib.util.spec_from_file_location('dod_stack', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    nearest rank percentile
+    :rtype: float
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    """
+    sends fd 2 to /dev/null, the progress bars and the ssh and tmux child processes write to it
+    """
+    sys.stderr.flush()
+    saved = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved, 2)
+        os.close(saved)
+        os.close(devnull)
+
+
+def run_once(dod_stack, sandbox: Sandbox) -> dict:
+    """
+    one launch, up to clean up, with its own LocalStack like a fresh run of the script
+    :rtype: dict
+    :return: ok, error, end to end ms and ms per phase
+    """
+    devnull = open(os.devnull, 'w')
+    start = time.perf_counter()
+    stack = dod_stack.LocalStack(config_path=sandbox.config_path, env_name=sandbox.env_names[0],
+                                 interactive=False, log_stream=devnull)
+    error = None
+    try:
+        with quiet_stderr():
+            ok = stack.main(sandbox.env_names)['ok']
+    except dod_stack.StackError as e:
+        ok, error = False, dod_stack.plain(e)
+        stack.clean_up(owned_only=True)
+    end_to_end = (time.perf_counter() - start) * 1000
+    stack.http.close()
+    stack.log_pipeline.stop()  # the log is written on the listener thread, devnull must outlive it
+    devnull.close()
+    phases = stack.profiler.totals()
+    phases.pop('total', None)
+    return {'ok': ok, 'error': error, 'end_to_end': end_to_end, 'phases': phases}
+
+
+def summarise(runs: List[dict]) -> dict:
+    """
+    :rtype: dict
+    :return: p50, p95 and max per phase over the runs that succeeded
+    """
+    ok_runs = [run for run in runs if run['ok']]
+    timings = {'end_to_end': [run['end_to_end'] for run in ok_runs]}
+    for run in ok_runs:
+        for phase, ms in run['phases'].items():
+            timings.setdefault(phase, []).append(ms)
+    errors: Dict[str, int] = {}
+    for run in runs:
+        if not run['ok']:
+            errors[run['error'] or 'stack did not start'] = errors.get(run['error'] or 'stack did not start', 0) + 1
+    return {
+        'runs': len(runs),
+        'failed': len(runs) - len(ok_runs),
+        'errors': errors,
+        'ms': {phase: {'p50': round(percentile(values, 50), 1), 'p95': round(percentile(values, 95), 1),
+                       'max': round(max(values), 1), 'n': len(values)}
+               for phase, values in timings.items() if values},
+    }
+
+
+def parse_faults(pairs: Optional[List[str]], what: str) -> Dict[str, float]:
+    faults = {}
+    for pair in pairs or []:
+        service, _, value = pair.partition('=')
+        if service not in SERVICES or not value:
+            raise SystemExit(f'--{what} takes SERVICE=VALUE with SERVICE one of {", ".join(SERVICES)}, got {pair}')
+        faults[service] = float(value)
+    return faults
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks a full dod-stack.py launch against local stand-ins.')
+    parser.add_argument('-n', '--iterations', type=int, default=20, help='launches to time (default 20)')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed launches first (default 1)')
+    parser.add_argument('--env', nargs='+', default=['dev2'], metavar='ENV', help='envs to tunnel to (default dev2)')
+    parser.add_argument('--latency', nargs='+', metavar='SERVICE=MS',
+                        help=f'added latency per request or command, SERVICE one of {", ".join(SERVICES)}')
+    parser.add_argument('--fail', nargs='+', metavar='SERVICE=RATE', help='failure rate from 0 to 1 per service')
+    parser.add_argument('--warm', action='store_true', help='keep the check cache between launches')
+    parser.add_argument('--launcher', choices=('panes', 'tmuxp'), default='panes',
+                        help='start the services with the launcher or tmuxp load (default panes)')
+    parser.add_argument('--seed', type=int, help='seed for the injected failures')
+    parser.add_argument('--json', action='store_true', help='print the summary as json')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    faults = Faults(parse_faults(args.latency, 'latency'), parse_faults(args.fail, 'fail'))
+    dod_stack = load_dod_stack()
+    runs = []
+    with Sandbox(args.env, faults, args.launcher) as sandbox:
+        for iteration in range(args.warmup + args.iterations):
+            sandbox.reset(args.warm)
+            run = run_once(dod_stack, sandbox)
+            if iteration >= args.warmup:
+                runs.append(run)
+    summary = summarise(runs)
+
+    if args.json:
+        print(json.dumps(dict(summary, latency=faults.latency, failure=faults.failure, envs=args.env,
+                              warm=args.warm, launcher=args.launcher), indent=2))
+        return 0
+    print(f'{summary["runs"]} launches, {summary["failed"]} failed'
+          f'{" (cache warm)" if args.warm else ""}, envs {" ".join(args.env)}, {args.launcher} launcher')
+    for error, count in sorted(summary['errors'].items(), key=lambda item: -item[1]):
+        print(f'  {count:>4} x {error}')
+    print(f'{"phase":<24}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}{"n":>6}')
+    for phase, stats in sorted(summary['ms'].items(), key=lambda item: -item[1]['p50']):
+        print(f'{phase:<24}{stats["p50"]:>10.1f}{stats["p95"]:>10.1f}{stats["max"]:>10.1f}{stats["n"]:>6}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
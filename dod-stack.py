@@ -4,271 +4,2414 @@ import os
 import json
 import getpass
 import sys
+import argparse
+import atexit
 import logging
+import logging.handlers
+import re
+import glob
 import time
+import shlex
+import signal
+import fnmatch
+import asyncio
+import ssl
+import base64
+import socket
+import threading
+import queue
+import http.client
+import urllib.parse
+import urllib.request
+import contextlib
+import itertools
 import concurrent.futures as cf
-from typing import List
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
-try:
-    from tqdm.auto import tqdm
-except ImportError:
-    subprocess.run('pip install tqdm -q', shell=True)
-    from tqdm.auto import tqdm
+"""
+Author: Saatvik Gulati
+Date: 18/11/2024
+Description: Runs a local stack and performs necessary checks.
+Requirements: Linux operating system, with env definitions updated in ssh config and .pgpass.
+              Requires dev2 env to be up to connect to any env
+Usage Example:
+    To run the file, use the command 'python dod-stack.py' or 'python3 dod-stack.py' or dod-stack.py if alias is set.
+    When prompted, enter the env you want to ssh to (prp1, dev1, or dev2).
+    Subcommands: 'up --env dev2', 'check', 'down' and 'status', add --json for machine readable output.
+    From python: 'from dod_stack import LocalStack' then 'LocalStack(env_name='dev2', interactive=False).check()'.
+
+"""
+
+
+class SimpleProgress:
+    """
+    Stand-in for tqdm when it isn't installed, renders a single line on stderr when it is a terminal
+    """
+
+    def __init__(self, total: int = 100, desc: str = '', **_):
+        self.total = total
+        self.desc = desc
+        self.n = 0
+        self.enabled = sys.stderr.isatty()  # like tqdm with disable=None, no \r or escapes in a pipe or log
+
+    def __enter__(self):
+        self._render()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _render(self):
+        if not self.enabled:
+            return
+        filled = int(10 * self.n / self.total) if self.total else 10
+        percent = int(100 * self.n / self.total) if self.total else 100
+        sys.stderr.write(f'\r{self.desc}: {percent:3d}%|{"#" * filled}{" " * (10 - filled)}|\x1b[0m\x1b[K')
+        sys.stderr.flush()
+
+    def update(self, n: int = 1):
+        self.n = min(self.n + n, self.total)
+        self._render()
+
+    def set_description(self, desc: str):
+        self.desc = desc
+        self._render()
+
+    def close(self):
+        if self.enabled:
+            sys.stderr.write('\n')
+            sys.stderr.flush()
+
+
+def progress_bar(**kwargs):
+    """
+    tqdm progress bar when it is installed, imported on first use so startup doesn't pay for it
+    :return: tqdm or SimpleProgress
+    """
+    try:
+        from tqdm.auto import tqdm
+    except ImportError:
+        return SimpleProgress(**kwargs)
+    return tqdm(**dict({'disable': None}, **kwargs))  # None turns the bar off when stderr is not a terminal
+
+
+class Profiler:
+    """
+    Records wall time of launch phases and of every command spawned
+    for a sorted summary or a chrome trace (chrome://tracing, ui.perfetto.dev)
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events: List[dict] = []
+        self._lock = threading.Lock()
+        self._threads: Dict[int, int] = {}
+
+    def record(self, name: str, category: str, start: float, duration: float, **args):
+        """
+        adds one finished event, start is a time.perf_counter() value
+        :rtype: void
+        """
+        with self._lock:
+            tid = self._threads.setdefault(threading.get_ident(), len(self._threads) + 1)
+            self.events.append({'name': name, 'cat': category, 'start': start - self.origin,
+                                'dur': duration, 'tid': tid, 'args': args})
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **args):
+        """
+        times the body of a with block as a phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, 'phase', start, time.perf_counter() - start, **args)
+
+    def run(self, cmd, **kwargs) -> subprocess.CompletedProcess:
+        """
+        subprocess.run that records the command, its exit code and wall time
+        :rtype: subprocess.CompletedProcess
+        """
+        start = time.perf_counter()
+        returncode = None
+        try:
+            result = subprocess.run(cmd, **kwargs)
+            returncode = result.returncode
+            return result
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+            raise
+        finally:
+            self.record_command(cmd, start, returncode)
+
+    def record_command(self, cmd, start: float, returncode: Optional[int]):
+        """
+        records a command that has finished, returncode None means it never completed
+        :rtype: void
+        """
+        if not isinstance(cmd, str):
+            # KEY=value after -e is an environment value, often a password, keep it out of shared traces
+            cmd = [re.sub(r'=.*', '=***', arg) if previous == '-e' else arg for previous, arg in zip([''] + cmd, cmd)]
+        command = cmd if isinstance(cmd, str) else ' '.join(cmd)
+        self.record(command.split()[0] if command.split() else command, 'subprocess', start,
+                    time.perf_counter() - start, command=command, exit_code=returncode)
+
+    def summary(self) -> str:
+        """
+        :rtype: str
+        :return: every event slowest first, one per line
+        """
+        lines = [f'{"ms":>10}  {"kind":<10}  what']
+        for event in sorted(self.events, key=lambda e: e['dur'], reverse=True):
+            what = event['args'].get('command', event['name'])
+            if event['cat'] == 'subprocess':
+                what = f'{what}  [exit {event["args"].get("exit_code")}]'
+            lines.append(f'{event["dur"] * 1000:>10.1f}  {event["cat"]:<10}  {what}')
+        lines.append(f'{(time.perf_counter() - self.origin) * 1000:>10.1f}  {"total":<10}  since start')
+        return '\n'.join(lines)
+
+    def totals(self) -> Dict[str, float]:
+        """
+        :rtype: Dict[str, float]
+        :return: ms spent per phase, summed when a phase ran more than once, and in total since start
+        """
+        totals: Dict[str, float] = {}
+        for event in self.events:
+            if event['cat'] == 'phase':
+                totals[event['name']] = totals.get(event['name'], 0.0) + event['dur'] * 1000
+        totals = {name: round(ms, 1) for name, ms in totals.items()}
+        totals['total'] = round((time.perf_counter() - self.origin) * 1000, 1)
+        return totals
+
+    def write_trace(self, path: str):
+        """
+        writes the events in chrome trace event json format
+        :rtype: void
+        """
+        pid = os.getpid()
+        trace = [{'name': event['name'], 'cat': event['cat'], 'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                  'ts': round(event['start'] * 1e6), 'dur': round(event['dur'] * 1e6), 'args': event['args']}
+                 for event in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+class ProbeResult(NamedTuple):
+    """
+    Outcome of a single http probe
+    status is 0 when no http response was received, error then holds the reason
+    """
+    url: str
+    status: int
+    latency: float
+    error: Optional[str] = None
+
+
+class HttpProbe:
+    """
+    Probes http(s) urls over pooled keep-alive connections
+    so repeated checks don't pay for a new process, tcp and tls handshake every time;
+    http_proxy, https_proxy and no_proxy are honoured like curl did, https goes through the proxy with CONNECT
+    """
+
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self._pool: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._busy: Set[http.client.HTTPConnection] = set()
+        self._aborted: Set[http.client.HTTPConnection] = set()
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+        self._proxies = urllib.request.getproxies()
+
+    def _proxy(self, scheme: str, host: str) -> Optional[urllib.parse.SplitResult]:
+        """
+        :rtype: urllib.parse.SplitResult
+        :return: proxy to reach host through, None when there is none for scheme or no_proxy matches host
+        """
+        proxy = self._proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass_environment(host, self._proxies):
+            return None
+        return urllib.parse.urlsplit(proxy if '://' in proxy else f'http://{proxy}')
+
+    @staticmethod
+    def _proxy_headers(proxy: urllib.parse.SplitResult) -> Dict[str, str]:
+        """
+        :rtype: Dict[str, str]
+        :return: Proxy-Authorization for a proxy url with user:password, otherwise nothing
+        """
+        if proxy.username is None:
+            return {}
+        credentials = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+        return {'Proxy-Authorization': f'Basic {base64.b64encode(credentials.encode()).decode()}'}
+
+    def _acquire(self, scheme: str, host: str, port: int, timeout: float,
+                 proxy: Optional[urllib.parse.SplitResult] = None) -> http.client.HTTPConnection:
+        """
+        takes an idle connection from the pool or opens a new one
+        :param proxy: proxy a new connection goes through
+        :rtype: http.client.HTTPConnection
+        :return: connection to host:port
+        """
+        with self._lock:
+            idle = self._pool.get((scheme, host, port))
+            conn = idle.pop() if idle else None
+        if conn is None:
+            # 1080 is what curl assumes for a proxy without a port
+            address = (proxy.hostname, proxy.port or 1080) if proxy is not None else (host, port)
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(*address, timeout=timeout, context=self._ssl_context)
+                if proxy is not None:
+                    conn.set_tunnel(host, port, headers=HttpProbe._proxy_headers(proxy))
+            else:
+                conn = http.client.HTTPConnection(*address, timeout=timeout)
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        with self._lock:
+            self._busy.add(conn)
+        return conn
+
+    def _check_in(self, conn: http.client.HTTPConnection) -> bool:
+        """
+        marks a connection as no longer in use
+        :rtype: bool
+        :return: True if abort broke its request off
+        """
+        with self._lock:
+            self._busy.discard(conn)
+            aborted = conn in self._aborted
+            self._aborted.discard(conn)
+        return aborted
+
+    def _release(self, scheme: str, host: str, port: int, conn: http.client.HTTPConnection):
+        """
+        puts a connection back in the pool for reuse
+        :rtype: void
+        """
+        with self._lock:
+            self._pool.setdefault((scheme, host, port), []).append(conn)
+
+    def probe(self, url: str, method: str = 'HEAD', timeout: Optional[float] = None,
+              cancelled: Optional[threading.Event] = None) -> ProbeResult:
+        """
+        sends a single request to url, a stale pooled connection is retried once on a fresh one
+        :param url: url to probe
+        :param method: http method
+        :param timeout: seconds to wait for connect and response, defaults to self.timeout
+        :param cancelled: set before abort is called, a probe starting after that gives up at once
+        :rtype: ProbeResult
+        :return: status code and latency of the request
+        """
+        timeout = self.timeout if timeout is None else timeout
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        host = parts.hostname or ''
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        headers = {'Connection': 'keep-alive'}
+        proxy = self._proxy(scheme, host)
+        if proxy is not None and scheme != 'https':
+            path = urllib.parse.urlunsplit((scheme, parts.netloc, path, '', ''))  # a plain http proxy wants the full url
+            headers.update(HttpProbe._proxy_headers(proxy))
+
+        start = time.perf_counter()
+        for attempt in range(2):
+            conn = self._acquire(scheme, host, port, timeout, proxy)
+            reused = conn.sock is not None
+            try:
+                if cancelled is not None and cancelled.is_set():
+                    self._abort_one(conn)
+                self._raise_if_aborted(conn)
+                if not reused:
+                    conn.connect()
+                    self._raise_if_aborted(conn)  # abort came while connecting, before there was a socket to shut
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                aborted = self._check_in(conn)
+                if reused and attempt == 0 and not aborted:
+                    continue  # server dropped the idle connection, retry on a new one
+                return ProbeResult(url, 0, time.perf_counter() - start,
+                                   'aborted' if aborted else str(e) or type(e).__name__)
+            if self._check_in(conn) or response.will_close:
+                conn.close()
+            else:
+                self._release(scheme, host, port, conn)
+            return ProbeResult(url, response.status, time.perf_counter() - start)
+
+    def abort(self):
+        """
+        breaks the in-flight requests off from another thread, they fail at once instead of retrying
+        :rtype: void
+        """
+        with self._lock:
+            busy = list(self._busy)
+        for conn in busy:
+            self._abort_one(conn)
+
+    def _raise_if_aborted(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            if conn in self._aborted:
+                raise OSError('aborted')
+
+    def _abort_one(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._aborted.add(conn)
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        closes every pooled connection
+        :rtype: void
+        """
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for conns in pool.values():
+            for conn in conns:
+                conn.close()
+
+
+class DockerError(Exception):
+    """
+    Docker engine api answered with an error status
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f'docker api {status}: {message}')
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    http.client connection over a unix domain socket
+    """
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerClient:
+    """
+    Minimal docker engine api client talking to the daemon socket directly
+    instead of spawning the docker cli for every query
+    """
+
+    def __init__(self, socket_path: str = '/var/run/docker.sock', timeout: float = 10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._conn: Optional[UnixHTTPConnection] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def socket_from_env(default: str) -> str:
+        """
+        honours DOCKER_HOST when it points at a unix socket
+        :param default: socket path to use otherwise
+        :rtype: str
+        :return: path of the docker socket
+        """
+        docker_host = os.environ.get('DOCKER_HOST', '')
+        if docker_host.startswith('unix://'):
+            return docker_host[len('unix://'):]
+        return default
+
+    def request(self, method: str, path: str, body=None, timeout: Optional[float] = None, raw: bool = False):
+        """
+        sends one api request over the kept-alive socket connection
+        :param method: http method
+        :param path: api path including query string
+        :param body: json serialisable request body
+        :param timeout: seconds to wait, defaults to self.timeout
+        :param raw: return the body as text even when it is json, for streamed newline delimited replies
+        :return: decoded json body, raw text for non json replies or None when empty
+        :exception DockerError: status code >= 400
+        :exception OSError: daemon not reachable
+        """
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        with self._lock:
+            for attempt in range(2):
+                if self._conn is None:
+                    self._conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+                conn = self._conn
+                reused = conn.sock is not None
+                conn.timeout = self.timeout if timeout is None else timeout
+                if reused:
+                    conn.sock.settimeout(conn.timeout)
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    self._conn = None
+                    if reused and attempt == 0:
+                        continue  # daemon closed the idle connection, retry on a new one
+                    raise
+                if response.will_close:
+                    conn.close()
+                    self._conn = None
+                break
+
+        text = data.decode(errors='replace')
+        if response.status >= 400:
+            try:
+                message = json.loads(text).get('message', text)
+            except ValueError:
+                message = text
+            raise DockerError(response.status, message.strip())
+        if not text:
+            return None
+        if not raw and response.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(text)
+        return text
+
+    def find_container(self, name: str) -> Optional[dict]:
+        """
+        looks up a container by exact name in any state, doubles as the daemon liveness check
+        :param name: container name
+        :rtype: dict
+        :return: container summary or None if it doesn't exist
+        """
+        containers = self.find_containers(name=[f'^/{name}$'])
+        return containers[0] if containers else None
+
+    def find_containers(self, **filters: List[str]) -> List[dict]:
+        """
+        lists containers in any state matching docker api filters, e.g. label=['key=value']
+        :rtype: List[dict]
+        """
+        query = urllib.parse.quote(json.dumps(filters))
+        return self.request('GET', f'/containers/json?all=1&filters={query}') or []
+
+    def start(self, container: str):
+        """
+        starts a created or exited container
+        :param container: container id or name
+        :rtype: void
+        """
+        self.request('POST', f'/containers/{urllib.parse.quote(container)}/start')
+
+    def pull(self, image: str, tag: str = 'latest', timeout: float = 300):
+        """
+        pulls an image, the daemon streams progress as one json object per line which is read to the end
+        :rtype: void
+        :exception DockerError: pull failed
+        """
+        query = urllib.parse.urlencode({'fromImage': image, 'tag': tag})
+        progress = self.request('POST', f'/images/create?{query}', timeout=timeout, raw=True) or ''
+        for line in progress.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict) and 'error' in event:
+                raise DockerError(500, event['error'])
+
+    def image_id(self, image: str) -> Optional[str]:
+        """
+        looks up a local image without pulling it
+        :param image: image reference with tag
+        :rtype: str
+        :return: image id or None if the daemon doesn't have it
+        """
+        try:
+            return self.request('GET', f'/images/{urllib.parse.quote(image, safe="/:")}/json')['Id']
+        except DockerError as e:
+            if e.status != 404:
+                raise
+            return None
+
+    def create(self, name: str, image: str, port_bindings: Dict[str, Tuple[str, int]],
+               labels: Optional[Dict[str, str]] = None, binds: Optional[List[str]] = None,
+               cmd: Optional[List[str]] = None) -> str:
+        """
+        creates a container, pulling the image first if the daemon doesn't have it
+        :param name: container name
+        :param image: image reference with tag, or an image id which is never pulled
+        :param port_bindings: container port (e.g. 6379/tcp) to (host ip, host port)
+        :param labels: container labels
+        :param binds: volume:container path mounts
+        :param cmd: command instead of the image default
+        :rtype: str
+        :return: id of the new container
+        """
+        body = {
+            'Image': image,
+            'Labels': labels or {},
+            'ExposedPorts': {port: {} for port in port_bindings},
+            'HostConfig': {
+                'PortBindings': {port: [{'HostIp': ip, 'HostPort': str(host_port)}]
+                                 for port, (ip, host_port) in port_bindings.items()}
+            },
+        }
+        if binds:
+            body['HostConfig']['Binds'] = binds
+        if cmd:
+            body['Cmd'] = cmd
+        path = f'/containers/create?name={urllib.parse.quote(name)}'
+        try:
+            created = self.request('POST', path, body)
+        except DockerError as e:
+            if e.status != 404 or image.startswith('sha256:'):
+                raise
+            repository, _, tag = image.rpartition(':')
+            self.pull(repository or image, tag if repository else 'latest')
+            created = self.request('POST', path, body)
+        return created['Id']
+
+    def run(self, name: str, image: str, port_bindings: Dict[str, Tuple[str, int]],
+            labels: Optional[Dict[str, str]] = None, binds: Optional[List[str]] = None,
+            cmd: Optional[List[str]] = None) -> str:
+        """
+        equivalent of docker run -d: create then start
+        :rtype: str
+        :return: id of the running container
+        """
+        container_id = self.create(name, image, port_bindings, labels, binds, cmd)
+        self.start(container_id)
+        return container_id
+
+    def remove(self, container: str):
+        """
+        force removes a container with its anonymous volumes, named volumes are left alone
+        :param container: container id or name
+        :rtype: void
+        """
+        try:
+            self.request('DELETE', f'/containers/{urllib.parse.quote(container)}?force=1&v=1')
+        except DockerError as e:
+            if e.status != 404:
+                raise
+
+    def abort(self):
+        """
+        breaks an in-flight request from another thread
+        :rtype: void
+        """
+        conn = self._conn
+        sock = conn.sock if conn is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class CheckCache:
+    """
+    On disk record of recently passed checks so a relaunch can skip them
+    every entry is dropped as soon as one of the watched files changes
+    """
+
+    def __init__(self, path: str, ttls: Dict[str, float], watched: Callable[[], List[str]]):
+        """
+        :param watched: called for the files to fingerprint each time, so files included later are watched too
+        """
+        self.path = path
+        self.ttls = ttls
+        self.watched = watched
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, float]] = None
+        self._fingerprint: Optional[List] = None
+
+    def fingerprint(self) -> List:
+        """
+        mtime and size of every watched file
+        :rtype: List
+        :return: [path, mtime_ns, size] per file, None for a missing file
+        """
+        prints = []
+        for path in self.watched():
+            try:
+                st = os.stat(path)
+                prints.append([path, st.st_mtime_ns, st.st_size])
+            except OSError:
+                prints.append([path, None, None])
+        return prints
+
+    def _load(self) -> Dict[str, float]:
+        """
+        reads the cache file once, the entries are dropped whenever the watched files changed since,
+        also while this process runs
+        :rtype: Dict[str, float]
+        :return: check name to time it last passed
+        """
+        fingerprint = self.fingerprint()
+        if self._entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                valid = data.get('fingerprint') == fingerprint
+                self._entries = data.get('passed', {}) if valid else {}
+            except (OSError, ValueError, AttributeError):
+                self._entries = {}
+        elif fingerprint != self._fingerprint:
+            self._entries = {}
+        self._fingerprint = fingerprint
+        return self._entries
+
+    def _save(self):
+        """
+        writes the cache atomically so concurrent launches never read half a file
+        :rtype: void
+        """
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'fingerprint': self._fingerprint, 'passed': self._entries}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # cache is best effort, an unwritable dir just means no caching
+
+    def ttl(self, name: str) -> float:
+        """
+        ttl of a check, keyed on the part before ':' so env:dev2 uses the env ttl
+        :rtype: float
+        """
+        return float(self.ttls.get(name.split(':')[0], 0))
+
+    def fresh(self, name: str) -> bool:
+        """
+        :param name: check name
+        :rtype: bool
+        :return: True if the check passed within its ttl and nothing watched changed
+        """
+        with self._lock:
+            passed = self._load().get(name)
+        return passed is not None and 0 <= time.time() - passed < self.ttl(name)
+
+    def mark(self, name: str):
+        """
+        records a check as passed now
+        :rtype: void
+        """
+        if self.ttl(name) <= 0:
+            return
+        with self._lock:
+            self._load()[name] = time.time()
+            self._save()
+
+    def invalidate(self, *names: str):
+        """
+        forgets the given checks, or every check when none are given
+        :rtype: void
+        """
+        with self._lock:
+            entries = self._load()
+            if not names:
+                entries.clear()
+            for name in names:
+                entries.pop(name, None)
+            self._save()
+
+
+class SshHostBlock(NamedTuple):
+    """
+    One Host (or Match) section of an ssh config, options keyed by lowercased keyword in file order
+    """
+    patterns: List[str]
+    options: Dict[str, List[str]]
+
+
+class SshConfig:
+    """
+    Parsed model of an ssh client config with Include expanded
+    Host lookups follow ssh: blocks are tried in file order, the first value of an option wins
+    except for the forwarding and identity options which accumulate across every matching block
+    """
+
+    ACCUMULATING = {'localforward', 'remoteforward', 'dynamicforward', 'identityfile', 'certificatefile', 'sendenv'}
+    MAX_INCLUDE_DEPTH = 16
+
+    _memo: Dict[str, 'SshConfig'] = {}
+    _memo_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self.blocks: List[SshHostBlock] = [SshHostBlock(['*'], {})]  # options before the first Host apply to all
+        self.watched: Dict[str, Optional[Tuple[int, int]]] = {}
+        self._index: Dict[str, Dict[str, List[str]]] = {}
+        self._index_lock = threading.Lock()
+        self._parse_file(self.path, 0)
+        for block in self.blocks:
+            for pattern in block.patterns:
+                if not any(c in pattern for c in '*?!'):
+                    self.options(pattern)
+
+    @classmethod
+    def load(cls, path: str) -> 'SshConfig':
+        """
+        parsed config for path, reparsed only when it or an included file changes
+        :param path: ssh config path
+        :rtype: SshConfig
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        with cls._memo_lock:
+            cached = cls._memo.get(path)
+            if cached is not None and not cached.changed():
+                return cached
+        parsed = cls(path)
+        with cls._memo_lock:
+            cls._memo[path] = parsed
+        return parsed
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        """
+        :rtype: bool
+        :return: True if any file or include directory read while parsing has changed
+        """
+        return any(SshConfig._stat(path) != stamp for path, stamp in self.watched.items())
+
+    def _parse_file(self, path: str, depth: int):
+        """
+        appends the blocks of one file, recursing into Include
+        :rtype: void
+        """
+        self.watched[path] = SshConfig._stat(path)
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = re.match(r'(\S+?)\s*(?:=\s*|\s+)(.*)$', line)
+            if not match:
+                continue
+            keyword, value = match.group(1).lower(), match.group(2).strip()
+            try:
+                args = shlex.split(value)
+            except ValueError:
+                args = value.split()
+
+            if keyword == 'host':
+                self.blocks.append(SshHostBlock(args, {}))
+            elif keyword == 'match':
+                # only 'Match all' can be decided without running ssh, anything else never matches here
+                self.blocks.append(SshHostBlock(['*'] if [a.lower() for a in args] == ['all'] else [], {}))
+            elif keyword == 'include':
+                if depth >= SshConfig.MAX_INCLUDE_DEPTH:
+                    continue
+                outer = self.blocks[-1]
+                for pattern in args:
+                    pattern = os.path.expanduser(pattern)
+                    if not os.path.isabs(pattern):
+                        pattern = os.path.join(os.path.expanduser('~/.ssh'), pattern)
+                    self.watched[os.path.dirname(pattern)] = SshConfig._stat(os.path.dirname(pattern))
+                    for included in sorted(glob.glob(pattern)):
+                        self._parse_file(included, depth + 1)
+                if self.blocks[-1] is not outer:
+                    # like ssh, the options after an Include are back in the Host that contained it
+                    self.blocks.append(SshHostBlock(outer.patterns, {}))
+            else:
+                self.blocks[-1].options.setdefault(keyword, []).append(value)
+
+    @staticmethod
+    def host_matches(patterns: List[str], host: str) -> bool:
+        """
+        ssh pattern list semantics: a matching negated pattern rejects, otherwise any positive match accepts
+        :rtype: bool
+        """
+        matched = False
+        for pattern in patterns:
+            negated = pattern.startswith('!')
+            if fnmatch.fnmatchcase(host, pattern.lstrip('!').lower()):
+                if negated:
+                    return False
+                matched = True
+        return matched
+
+    def options(self, host: str) -> Dict[str, List[str]]:
+        """
+        effective options for a host, resolved once and then served from the index
+        :param host: host alias as given to ssh
+        :rtype: Dict[str, List[str]]
+        :return: lowercased keyword to its values
+        """
+        host = host.lower()
+        resolved = self._index.get(host)
+        if resolved is not None:
+            return resolved
+        resolved = {}
+        for block in self.blocks:
+            if not SshConfig.host_matches(block.patterns, host):
+                continue
+            for keyword, values in block.options.items():
+                if keyword in SshConfig.ACCUMULATING:
+                    resolved.setdefault(keyword, []).extend(values)
+                elif keyword not in resolved:
+                    resolved[keyword] = values[:1]
+        with self._index_lock:
+            self._index[host] = resolved
+        return resolved
+
+    def local_forwards(self, host: str) -> List[int]:
+        """
+        local ports forwarded for a host, unix socket forwards are skipped
+        :param host: host alias as given to ssh
+        :rtype: List[int]
+        """
+        ports = []
+        for value in self.options(host).get('localforward', []):
+            listen = value.split()[0] if value.split() else ''
+            port = listen.rsplit(':', 1)[-1]
+            if port.isdigit() and int(port) not in ports:
+                ports.append(int(port))
+        return ports
+
+
+class EnvFile:
+    """
+    KEY=value pairs of a dotenv file, parsed once the way dotenv -e .env reads it
+    with python-dotenv when installed, otherwise by the same rules for single line values: quotes and escapes,
+    inline comments after unquoted values, ${VAR} and ${VAR:-default} from earlier keys or the environment
+    """
+
+    LINE = re.compile(r'^\s*(?:export\s+)?(?P<key>[^=#\s]+)\s*=\s*(?P<value>.*)$')
+    DOUBLE_QUOTED = re.compile(r'"((?:\\.|[^"\\])*)"')
+    SINGLE_QUOTED = re.compile(r"'((?:\\.|[^'\\])*)'")
+    VARIABLE = re.compile(r'\$\{(?P<name>[^}:]*)(?::-(?P<default>[^}]*))?\}')
+    ESCAPES = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+               '\\': '\\', "'": "'", '"': '"'}
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'r') as f:
+            try:
+                from dotenv import dotenv_values  # the package behind the dotenv cli
+            except ImportError:
+                self.values = EnvFile.parse(f)
+            else:
+                self.values = {key: value for key, value in dotenv_values(stream=f).items() if value is not None}
+
+    @staticmethod
+    def parse(lines) -> Dict[str, str]:
+        """
+        :param lines: lines of a dotenv file
+        :rtype: Dict[str, str]
+        :return: the values after unquoting and interpolation
+        """
+        values: Dict[str, str] = {}
+        for line in lines:
+            match = EnvFile.LINE.match(line.rstrip('\r\n'))
+            if not match:
+                continue
+            raw = match.group('value')
+            double = EnvFile.DOUBLE_QUOTED.match(raw)
+            single = EnvFile.SINGLE_QUOTED.match(raw)
+            if single:
+                values[match.group('key')] = re.sub(r"\\([\\'])", r'\1', single.group(1))
+                continue
+            if double:
+                value = re.sub(r'\\(.)', lambda m: EnvFile.ESCAPES.get(m.group(1), m.group(0)), double.group(1))
+            else:
+                value = re.sub(r'\s+#.*', '', raw).rstrip()
+            env = dict(os.environ, **values)
+            values[match.group('key')] = EnvFile.VARIABLE.sub(
+                lambda m: env.get(m.group('name'), m.group('default') or ''), value)
+        return values
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return self.values.get(key, default)
+
+    def port_keys(self) -> Dict[str, str]:
+        """
+        :rtype: Dict[str, str]
+        :return: every *_PORT* key with its raw value
+        """
+        return {key: value for key, value in self.values.items() if '_PORT' in key.upper()}
+
+
+class PgPassEntry(NamedTuple):
+    host: str
+    port: Optional[int]  # None for a * wildcard
+    database: str
+    username: str
+
+
+class PgPass:
+    """
+    Entries of a .pgpass file indexed by host for port lookups
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: List[PgPassEntry] = []
+        self.ports_by_host: Dict[str, Set[int]] = {}
+        self.any_port_hosts: Set[str] = set()
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = [field.replace('\\:', ':') for field in re.split(r'(?<!\\):', line)]
+                if len(fields) < 5:
+                    continue
+                port = int(fields[1]) if fields[1].isdigit() else None
+                entry = PgPassEntry(fields[0], port, fields[2], fields[3])
+                self.entries.append(entry)
+                if port is not None:
+                    self.ports_by_host.setdefault(entry.host, set()).add(port)
+                else:
+                    self.any_port_hosts.add(entry.host)
+
+    def has_port(self, host: str, port: int) -> bool:
+        """
+        * in the host or port field matches anything, like libpq does
+        :rtype: bool
+        :return: True if .pgpass has an entry for host:port
+        """
+        return any(port in self.ports_by_host.get(h, ()) or h in self.any_port_hosts for h in (host, '*'))
+
+
+class SshTunnels:
+    """
+    Tracks the ssh tunnels this tool starts: each env gets its own ControlMaster socket and pid file
+    so liveness is a /proc lookup and clean up only ever touches our own processes
+    """
+
+    def __init__(self, run_dir: str, profiler: Optional[Profiler] = None):
+        self.run_dir = run_dir
+        self.profiler = profiler or Profiler()
+
+    def control_path(self, env_name: str) -> str:
+        return os.path.join(self.run_dir, f'ssh-{env_name}.ctl')
+
+    def pid_path(self, env_name: str) -> str:
+        return os.path.join(self.run_dir, f'ssh-{env_name}.pid')
+
+    def start(self, env_name: str, batch: bool = False) -> Optional[int]:
+        """
+        starts ssh -fN as a control master for env_name and records its pid
+        ssh keeps the terminal until authentication is done so password prompts still work
+        :param env_name: host alias from the ssh config
+        :param batch: never prompt or write to the terminal, for restarts while tmux owns it
+        :rtype: int
+        :return: pid of the tunnel or None if ssh failed
+        """
+        os.makedirs(self.run_dir, mode=0o700, exist_ok=True)
+        control_path = self.control_path(env_name)
+        batch_mode = ['-o', 'BatchMode=yes'] if batch else []
+        result = self.profiler.run(['ssh', '-fN', '-o', 'ControlMaster=yes', '-o', f'ControlPath={control_path}',
+                                    '-o', 'ExitOnForwardFailure=yes', *batch_mode, env_name],
+                                   stdin=subprocess.DEVNULL if batch else None,
+                                   stderr=subprocess.DEVNULL if batch else None)
+        if result.returncode != 0:
+            return None
+        pid = self._master_pid(env_name)
+        if pid is not None:
+            with open(self.pid_path(env_name), 'w') as f:
+                f.write(str(pid))
+        return pid
+
+    def _master_pid(self, env_name: str) -> Optional[int]:
+        """
+        asks the control master for its pid, falling back to finding it by command line
+        :rtype: int
+        """
+        control_path = self.control_path(env_name)
+        try:
+            result = self.profiler.run(['ssh', '-o', f'ControlPath={control_path}', '-O', 'check', env_name],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=5)
+            match = re.search(r'pid=(\d+)', result.stderr + result.stdout)
+            if match:
+                return int(match.group(1))
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        for pid in SshTunnels._proc_pids():
+            if SshTunnels._owns_control_path(pid, control_path):
+                return pid
+        return None
+
+    @staticmethod
+    def _proc_pids() -> List[int]:
+        return [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+
+    @staticmethod
+    def _owns_control_path(pid: int, control_path: str) -> bool:
+        """
+        :rtype: bool
+        :return: True if pid is an ssh master started with control_path
+        """
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                argv = f.read().decode(errors='replace').split('\0')
+        except OSError:
+            return False
+        return (bool(argv) and os.path.basename(argv[0]) == 'ssh' and '-O' not in argv
+                and f'ControlPath={control_path}' in argv)
+
+    def pid(self, env_name: str) -> Optional[int]:
+        """
+        pid of the tracked tunnel for env_name
+        :rtype: int
+        :return: pid or None if no tunnel of ours is alive
+        """
+        try:
+            with open(self.pid_path(env_name), 'r') as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        if SshTunnels._owns_control_path(pid, self.control_path(env_name)):
+            return pid
+        return None
+
+    def wanted(self) -> List[str]:
+        """
+        envs we started a tunnel for and haven't stopped, a tunnel that died stays wanted
+        :rtype: List[str]
+        """
+        return sorted(os.path.basename(path)[len('ssh-'):-len('.pid')]
+                      for path in glob.glob(os.path.join(self.run_dir, 'ssh-*.pid')))
+
+    def tracked(self) -> Dict[str, int]:
+        """
+        :rtype: Dict[str, int]
+        :return: env name to pid of every live tunnel we started
+        """
+        tunnels = {}
+        for env_name in self.wanted():
+            pid = self.pid(env_name)
+            if pid is not None:
+                tunnels[env_name] = pid
+        return tunnels
+
+    def stop(self, env_name: str, forget: bool = True) -> bool:
+        """
+        stops our tunnel for env_name, SIGTERM lets ssh remove its control socket
+        the env is no longer wanted afterwards even if its tunnel had already died
+        :param forget: False keeps the env wanted, for a restart that may fail
+        :rtype: bool
+        :return: True if a live tunnel was stopped
+        """
+        pid = self.pid(env_name)
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        self._forget(env_name, keep_wanted=not forget)
+        return pid is not None
+
+    @staticmethod
+    def port_in_use(port: int) -> bool:
+        """
+        :rtype: bool
+        :return: True if something is already listening on the local port
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('127.0.0.1', port))
+            except OSError:
+                return True
+        return False
+
+    def clashes(self, env_names: List[str], ssh_config: 'SshConfig') -> List[str]:
+        """
+        finds LocalForward ports that two tunnels would both bind, or that something else already holds
+        envs that already have a live tunnel of ours are taken into account but not reported against themselves
+        :param env_names: envs about to be started
+        :param ssh_config: parsed ssh config the ports come from
+        :rtype: List[str]
+        :return: one message per clash, empty when all envs can start side by side
+        """
+        running = self.tracked()
+        owners: Dict[int, str] = {}
+        for env_name in running:
+            for port in ssh_config.local_forwards(env_name):
+                owners.setdefault(port, env_name)
+
+        problems = []
+        for env_name in env_names:
+            if env_name in running:
+                continue
+            for port in ssh_config.local_forwards(env_name):
+                if port in owners:
+                    problems.append(f'port {port} of {env_name} is also forwarded by {owners[port]}')
+                elif SshTunnels.port_in_use(port):
+                    problems.append(f'port {port} of {env_name} is already in use by another process')
+                else:
+                    owners[port] = env_name
+        return problems
+
+    def up(self, env_names: List[str]) -> Dict[str, Optional[int]]:
+        """
+        starts the tunnels for env_names in parallel, several at once can't share the terminal so they run in batch mode
+        :rtype: Dict[str, Optional[int]]
+        :return: env name to pid, None where ssh failed
+        """
+        if len(env_names) == 1:
+            return {env_names[0]: self.start(env_names[0])}
+        with cf.ThreadPoolExecutor(max_workers=len(env_names), thread_name_prefix='ssh') as ex:
+            pids = ex.map(lambda env_name: self.start(env_name, batch=True), env_names)
+            return dict(zip(env_names, pids))
+
+    def _forget(self, env_name: str, keep_wanted: bool = False):
+        """
+        removes the control socket a dead master may have left, and the pid file unless keep_wanted
+        :rtype: void
+        """
+        paths = [self.control_path(env_name)] if keep_wanted else [self.pid_path(env_name), self.control_path(env_name)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def ssh_pids_on_port(port: int = 22) -> List[int]:
+        """
+        fallback for tunnels we didn't start: ssh processes holding an established connection to port
+        reads /proc/net/tcp{,6} and only the fds of processes named ssh instead of every fd like lsof
+        :rtype: List[int]
+        """
+        inodes = set()
+        for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+            try:
+                with open(table, 'r') as f:
+                    next(f, None)
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) > 9 and fields[3] == '01' and int(fields[2].rsplit(':', 1)[1], 16) == port:
+                            inodes.add(f'socket:[{fields[9]}]')
+            except OSError:
+                continue
+        if not inodes:
+            return []
+
+        pids = []
+        for pid in SshTunnels._proc_pids():
+            try:
+                with open(f'/proc/{pid}/comm', 'r') as f:
+                    if f.read().strip() != 'ssh':
+                        continue
+                fd_dir = f'/proc/{pid}/fd'
+                if any(os.readlink(os.path.join(fd_dir, fd)) in inodes for fd in os.listdir(fd_dir)):
+                    pids.append(pid)
+            except OSError:
+                continue
+        return pids
+
+
+class ChecksAbandoned(Exception):
+    """
+    Raised inside a check thread once the orchestrator has given up on it
+    """
+
+
+class StackError(Exception):
+    """
+    A check or step failed and the stack can't go on, raised instead of exiting so callers decide
+    """
+
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+def plain(text) -> str:
+    """
+    strips the terminal colors from a message
+    :rtype: str
+    """
+    return ANSI_ESCAPE.sub('', str(text)).strip()
+
+
+async def can_connect(port: int, timeout: float = 0.5, host: str = '127.0.0.1') -> bool:
+    """
+    one short connect to host:port, what the watchdog, the launcher and the tunnel wait all probe ports with
+    :rtype: bool
+    :return: True if the port accepted the connection within timeout
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+class CheckResult(NamedTuple):
+    """
+    Outcome of one check, cached when it passed recently and was skipped
+    """
+    name: str
+    ok: bool
+    duration: float
+    detail: str = ''
+    cached: bool = False
+
+
+class CheckFailed(Exception):
+    """
+    Carries the result of a failed check out of its executor thread
+    """
+
+    def __init__(self, result: CheckResult):
+        super().__init__(result.detail)
+        self.result = result
+
+
+class StackContext:
+    """
+    Config plus the parsed .env, .pgpass and ssh config every check reads, shared across the check threads
+    paths are absolute, files are parsed on first use and again only once they change on disk
+    """
+
+    def __init__(self, config_path: str):
+        """
+        :param config_path: config.json to load
+        :exception StackError: config file not found
+        """
+        self.config_path = os.path.abspath(os.path.expanduser(config_path))
+        if not os.path.exists(self.config_path):
+            raise StackError(f'Config file {self.config_path} not found')
+        with open(self.config_path, 'r') as f:
+            self.config: dict = json.load(f)
+        self.config_dir = os.path.dirname(self.config_path)
+        self.dod_root: Optional[str] = os.environ.get(self.config['DOD_ROOT'])
+        self.stack_dir: Optional[str] = os.path.join(os.path.abspath(self.dod_root), 'dod-stack') if self.dod_root else None
+        self.env_path: Optional[str] = os.path.join(self.stack_dir, '.env') if self.stack_dir else None
+        self.pgpass_path = os.path.abspath(os.path.expanduser(self.config['pgpass_path']))
+        self.ssh_config_path = os.path.abspath(os.path.expanduser(self.config['ssh_config_path']))
+        self._loaded: Dict[str, Tuple[Tuple[int, int], object]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, path: str, parse):
+        """
+        parsed file, reparsed when its mtime or size changed since the last call
+        :param path: absolute path
+        :param parse: callable building the model from the path
+        :exception StackError: file not found
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise StackError(f'{path} file not found')
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            loaded = self._loaded.get(path)
+            if loaded is None or loaded[0] != stamp:
+                loaded = (stamp, parse(path))
+                self._loaded[path] = loaded
+            return loaded[1]
+
+    @property
+    def env_file(self) -> EnvFile:
+        """
+        :rtype: EnvFile
+        :exception StackError: DOD_ROOT not set or .env not found
+        """
+        if not self.env_path:
+            raise StackError('env variable DOD_ROOT not set')
+        return self._load(self.env_path, EnvFile)
+
+    @property
+    def pgpass(self) -> PgPass:
+        """
+        :rtype: PgPass
+        :exception StackError: .pgpass not found
+        """
+        return self._load(self.pgpass_path, PgPass)
+
+    @property
+    def ssh_config(self) -> SshConfig:
+        """
+        ssh config, SshConfig.load already reparses it when it or an included file changes
+        :rtype: SshConfig
+        :exception StackError: ssh config not found
+        """
+        if not os.path.exists(self.ssh_config_path):
+            raise StackError(f'{self.ssh_config_path} file not found')
+        return SshConfig.load(self.ssh_config_path)
+
+    def files(self) -> List[str]:
+        """
+        :rtype: List[str]
+        :return: the ssh config, .pgpass and .env the checks read
+        """
+        return [path for path in (self.ssh_config_path, self.pgpass_path, self.env_path) if path]
+
+    def watched(self) -> List[str]:
+        """
+        :rtype: List[str]
+        :return: files whose change invalidates cached check results, including what the ssh config includes
+        """
+        paths = self.files()
+        try:
+            paths += [path for path in self.ssh_config.watched if path not in paths]
+        except StackError:
+            pass
+        return paths
+
+
+class ColorFormatter(logging.Formatter):
+    """
+    Colors the time, level and message of each record by level, messages themselves carry no escape codes
+    """
+
+    def __init__(self, colors: Dict[str, str], fmt: str, datefmt: str):
+        super().__init__(fmt=fmt, datefmt=datefmt)
+        self.reset = colors['NC']
+        self.level_colors = {
+            logging.DEBUG: colors['BLUE'],
+            logging.INFO: colors['GREEN'],
+            logging.WARNING: colors['AMBER'],
+            logging.ERROR: colors['RED'],
+            logging.CRITICAL: colors['RED'],
+        }
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        color = self.level_colors.get(record.levelno, '')
+        if not color:
+            return super().formatMessage(record)
+        values = dict(record.__dict__)
+        for field in ('asctime', 'levelname', 'message'):
+            leading = len(values[field]) - len(values[field].lstrip('\n'))
+            values[field] = f'{values[field][:leading]}{color}{values[field][leading:]}{self.reset}'
+        return super().formatMessage(logging.makeLogRecord(values))
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One json object per record for the log file: time, level, thread and the message without escape codes
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            'time': f'{self.formatTime(record, "%Y-%m-%dT%H:%M:%S")}.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': plain(record.getMessage()).strip('\n'),
+        })
+
+
+class LogPipeline:
+    """
+    Records are put on a queue by a single QueueHandler, a QueueListener thread formats and writes them
+    so the check threads never wait on the terminal or the log file;
+    configuring again swaps the sinks behind the queue instead of adding handlers to the logger;
+    each LocalStack owns one on its own logger, so two stacks in one process never write to each other's sinks
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.queue: queue.Queue = queue.Queue()
+        self.handler = logging.handlers.QueueHandler(self.queue)
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.handed_over = threading.Event()
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def configure(self, *handlers: logging.Handler):
+        """
+        replaces the sinks, records already queued go to the old ones first
+        :rtype: void
+        """
+        with self._lock:
+            self._stop()
+            self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+            self.listener.start()
+            if self.handler not in self.logger.handlers:
+                self.logger.addHandler(self.handler)
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+
+    def flush(self):
+        """
+        waits until every record logged so far is written, before prompting or handing the terminal over
+        :rtype: void
+        """
+        if self.listener is not None:
+            self.queue.join()
+
+    @contextlib.contextmanager
+    def terminal_handed_over(self):
+        """
+        while tmux owns the terminal nothing is written to the console, the file sink still gets every record
+        """
+        self.flush()
+        self.handed_over.set()
+        try:
+            yield
+        finally:
+            self.flush()
+            self.handed_over.clear()
+
+    def console_filter(self, record: logging.LogRecord) -> bool:
+        return not self.handed_over.is_set()
+
+    def stop(self):
+        """
+        writes what is queued, closes the sinks and detaches from the logger
+        :rtype: void
+        """
+        with self._lock:
+            self._stop()
+            self.logger.removeHandler(self.handler)
+            if self._registered:
+                atexit.unregister(self.stop)
+                self._registered = False
+
+    def _stop(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
+
+
+class Watchdog:
+    """
+    Keeps the vpn, ssh tunnels and redis healthy while the stack runs
+    the tunnels watched are re-read every round so ones added or dropped from the cli are picked up
+    probes are cheap connects and a keep-alive HEAD, the interval doubles while all is well
+    and drops back to the minimum after a failure; probing never uses more than cpu_budget of the time
+    """
+
+    def __init__(self, stack: 'LocalStack', redis_port: int = 6379,
+                 min_interval: float = 2.0, max_interval: float = 30.0, cpu_budget: float = 0.01):
+        self.stack = stack
+        self.redis_port = redis_port
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cpu_budget = cpu_budget
+        self.interval = min_interval
+        self.rounds = 0
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._started = threading.Event()
+
+    def start(self):
+        """
+        runs the watchdog loop on a daemon thread
+        :rtype: void
+        """
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._run()), name='watchdog', daemon=True)
+        self._thread.start()
+        self._started.wait(timeout=1)
+
+    def stop(self):
+        """
+        stops the loop and waits for the current round to finish
+        :rtype: void
+        """
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._started.set()
+        while True:
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            cpu_start = time.process_time()
+            healthy = await self._probe_round()
+            cpu_used = time.process_time() - cpu_start
+            self.rounds += 1
+            self.interval = min(self.interval * 2, self.max_interval) if healthy else self.min_interval
+            # stretch the interval when probing costs more cpu than the budget allows
+            self.interval = min(max(self.interval, cpu_used / self.cpu_budget), self.max_interval)
+
+    async def _ports_up(self, ports: List[int]) -> bool:
+        return all(await asyncio.gather(*(can_connect(port) for port in ports)))
+
+    async def _probe_round(self) -> bool:
+        """
+        probes everything concurrently and repairs what can be repaired
+        :rtype: bool
+        :return: True if everything was healthy
+        """
+        stack = self.stack
+        vpn = asyncio.to_thread(stack.http.probe, stack.config['vpn_url'], 'HEAD', stack.probe_timeout('vpn'))
+        try:
+            tunnels = stack.tunnel_ports(stack.tunnels.wanted())
+        except StackError as e:
+            self._log(logging.WARNING, 'Watchdog: %s', e)
+            tunnels = {}
+        env_names = list(tunnels)
+        vpn_result, redis_up, *tunnels_up = await asyncio.gather(
+            vpn, can_connect(self.redis_port), *(self._ports_up(tunnels[env]) for env in env_names))
+
+        healthy = True
+        if vpn_result.error is not None:
+            healthy = False
+            self._log(logging.WARNING, 'Watchdog: VPN is off (%s)', vpn_result.error)
+        if not redis_up:
+            healthy = False
+            await self._recover('redis', [self.redis_port], stack.docker_checks)
+        for env_name, up in zip(env_names, tunnels_up):
+            if not up and vpn_result.error is None:  # no point restarting a tunnel without the vpn
+                healthy = False
+                await self._recover(f'ssh tunnel to {env_name}', tunnels[env_name],
+                                    lambda env_name=env_name: self._restart_tunnel(env_name))
+        return healthy
+
+    def _log(self, level: int, msg: str, *args):
+        """
+        logs a watchdog line, while tmux owns the terminal it goes to the file sink and the session's status line
+        :rtype: void
+        """
+        self.stack.logger.log(level, msg, *args)
+        if self.stack.log_pipeline.handed_over.is_set():
+            self.stack.profiler.run(['tmux', 'display-message', '-t', LocalStack.TMUX_SESSION,
+                                     (msg % args).replace('#', '##')],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _restart_tunnel(self, env_name: str) -> bool:
+        # the env stays wanted if ssh fails to come back, so the next round retries it
+        self.stack.tunnels.stop(env_name, forget=False)
+        return self.stack.tunnels.start(env_name, batch=True) is not None
+
+    async def _recover(self, what: str, ports: List[int], repair):
+        """
+        runs repair off the loop and logs how long until the ports accepted connections again
+        :rtype: void
+        """
+        stack = self.stack
+        self._log(logging.WARNING, 'Watchdog: %s is down, restarting', what)
+        start = time.perf_counter()
+        try:
+            repaired = await asyncio.to_thread(repair)
+        except Exception as e:
+            repaired = False
+            self._log(logging.ERROR, 'Watchdog: restarting %s failed: %s', what, e)
+        if repaired:
+            ready = await stack._wait_for_ports(ports, float(stack.config.get('tunnel_ready_timeout', 10)))
+            repaired = all(elapsed is not None for elapsed in ready.values())
+        elapsed = time.perf_counter() - start
+        stack.profiler.record(f'recover {what}', 'watchdog', start, elapsed, recovered=repaired)
+        if repaired:
+            self._log(logging.INFO, 'Watchdog: %s recovered in %.0f ms', what, elapsed * 1000)
+        else:
+            self._log(logging.ERROR, 'Watchdog: %s still down after %.1fs', what, elapsed)
+
+
+class ServiceSpec(NamedTuple):
+    """
+    One window of dod-stack.yaml, with what it depends on and its readiness probe from the launcher config
+    panes are (start directory, shell commands) pairs, ready is {'port': n} or {'url': ...}
+    """
+    name: str
+    panes: List[Tuple[str, List[str]]]
+    layout: Optional[str]
+    depends_on: List[str]
+    ready: dict
+    timeout: float
+
+
+class ServiceResult(NamedTuple):
+    """
+    How one service came up, started is seconds after the launch its window opened, ready seconds after that
+    """
+    name: str
+    ok: bool
+    started: float
+    ready: float
+    detail: str = ''
+
+
+class StackLauncher:
+    """
+    Starts the windows of dod-stack.yaml in tmux itself instead of handing the file to tmuxp load
+    a window opens as soon as the services it depends on are ready, so independent ones start together
+    and the stack is usable once its critical path is, each service is timed and failures keep the pane output
+    """
+
+    BUILT_IN = {'redis', 'tunnel'}  # ready before the launcher runs
+    SHELLS = {'bash', 'zsh', 'sh', 'dash', 'fish', 'ksh'}
+    PLACEHOLDER = 'dod-stack'
+
+    def __init__(self, stack: 'LocalStack', session: str, yaml_path: str):
+        self.stack = stack
+        self.session = session
+        self.yaml_path = yaml_path
+        self.stack_dir = os.path.dirname(yaml_path)
+        settings = stack.config.get('launcher', {})
+        self.default_timeout = float(settings.get('ready_timeout', 60))
+        self.services = settings.get('services', {})
+        self.env_script = StackLauncher.env_script_path(stack.tunnels.run_dir)
 
-"""
-Author: Saatvik Gulati
-Date: 18/11/2024
-Description: Runs a local stack and performs necessary checks.
-Requirements: Linux operating system, with env definitions updated in ssh config and .pgpass.
-              Requires dev2 env to be up to connect to any env
-Usage Example:
-    To run the file, use the command 'python dod-stack.py' or 'python3 dod-stack.py' or dod-stack.py if alias is set.
-    When prompted, enter the env you want to ssh to (prp1, dev1, or dev2).
+    @staticmethod
+    def _commands(value) -> List[str]:
+        """
+        shell commands in any form tmuxp accepts: a string, or a list of strings or {cmd: ...}
+        :rtype: List[str]
+        """
+        if value is None or value in ('blank', 'pane'):
+            return []
+        if isinstance(value, (str, dict)):
+            value = [value]
+        commands = [item.get('cmd') if isinstance(item, dict) else item for item in value]
+        return [str(command) for command in commands if command]
 
-"""
+    @staticmethod
+    def _directory(value, base: str) -> str:
+        if not value:
+            return base
+        path = os.path.expandvars(os.path.expanduser(str(value)))
+        return path if os.path.isabs(path) else os.path.normpath(os.path.join(base, path))
+
+    def load(self) -> Tuple[dict, List[ServiceSpec]]:
+        """
+        reads dod-stack.yaml into one spec per window
+        :rtype: Tuple[dict, List[ServiceSpec]]
+        :return: the session section and the services
+        :exception StackError: unreadable yaml, an unknown dependency or a dependency cycle
+        """
+        import yaml  # installed with tmuxp, only the launcher needs it
+
+        try:
+            with open(self.yaml_path, 'r') as f:
+                session = yaml.safe_load(f) or {}
+        except OSError:
+            raise StackError(f'{self.yaml_path} file not found')
+        except yaml.YAMLError as e:
+            raise StackError(f'{self.yaml_path} is not valid yaml: {e}')
+
+        root = StackLauncher._directory(session.get('start_directory'), self.stack_dir)
+        before = StackLauncher._commands(session.get('shell_command_before'))
+        specs = []
+        for index, window in enumerate(session.get('windows') or []):
+            name = str(window.get('window_name') or index)
+            window_dir = StackLauncher._directory(window.get('start_directory'), root)
+            window_before = before + StackLauncher._commands(window.get('shell_command_before'))
+            panes = []
+            for pane in window.get('panes') or [None]:
+                if isinstance(pane, dict):
+                    pane_dir = StackLauncher._directory(pane.get('start_directory'), window_dir)
+                    panes.append((pane_dir, window_before + StackLauncher._commands(pane.get('shell_command'))))
+                else:
+                    panes.append((window_dir, window_before + StackLauncher._commands(pane)))
+            settings = self.services.get(name, {})
+            specs.append(ServiceSpec(name, panes, window.get('layout'), list(settings.get('depends_on', [])),
+                                     dict(settings.get('ready', {})), float(settings.get('timeout', self.default_timeout))))
+        StackLauncher.check_graph(specs)
+        return session, specs
+
+    @staticmethod
+    def check_graph(specs: List[ServiceSpec]):
+        """
+        :rtype: void
+        :exception StackError: a service depends on one that doesn't exist or the dependencies form a cycle
+        """
+        names = {spec.name for spec in specs}
+        for spec in specs:
+            unknown = [name for name in spec.depends_on if name not in names | StackLauncher.BUILT_IN]
+            if unknown:
+                raise StackError(f'{spec.name} depends on unknown service {", ".join(unknown)}')
+        waiting = {spec.name: set(spec.depends_on) & names for spec in specs}
+        while waiting:
+            free = [name for name, depends_on in waiting.items() if not depends_on]
+            if not free:
+                raise StackError(f'Dependency cycle between {", ".join(sorted(waiting))}')
+            for name in free:
+                del waiting[name]
+            for depends_on in waiting.values():
+                depends_on.difference_update(free)
+
+    def tmux(self, *args: str) -> str:
+        """
+        runs one tmux command
+        :rtype: str
+        :return: what it printed
+        :exception StackError: tmux failed
+        """
+        result = self.stack.profiler.run(['tmux', *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise StackError(f'tmux {args[0]} failed: {result.stderr.strip()}')
+        return result.stdout.strip()
+
+    def launch(self) -> List[ServiceResult]:
+        """
+        creates the session then brings every service up, each pane first sources .env from a file only we can read
+        :rtype: List[ServiceResult]
+        :exception StackError: yaml, before_script or tmux session failed
+        """
+        session, specs = self.load()
+        if session.get('before_script'):
+            before_script = StackLauncher._directory(session['before_script'], self.stack_dir)
+            if self.stack.profiler.run(before_script, shell=True, cwd=self.stack_dir).returncode != 0:
+                raise StackError(f'before_script {before_script} failed')
+        environment = dict(self.stack.context.env_file.values)
+        environment.update({key: str(value) for key, value in (session.get('environment') or {}).items()})
+        self.env_script = self.write_environment(environment)
+        self.tmux('new-session', '-d', '-s', self.session, '-n', StackLauncher.PLACEHOLDER, '-c', self.stack_dir)
+        results = asyncio.run(self._launch(specs))
+        if any(result.started or result.ok for result in results):
+            self.tmux('kill-window', '-t', f'{self.session}:{StackLauncher.PLACEHOLDER}')
+        return results
+
+    @staticmethod
+    def env_script_path(run_dir: str) -> str:
+        return os.path.join(run_dir, 'stack-env.sh')
+
+    def write_environment(self, environment: Dict[str, str]) -> str:
+        """
+        writes the session environment as export lines readable only by us,
+        so .env values such as passwords never appear in a command line or the profiler's trace
+        :rtype: str
+        :return: path of the script
+        """
+        run_dir = self.stack.tunnels.run_dir
+        os.makedirs(run_dir, mode=0o700, exist_ok=True)
+        path = StackLauncher.env_script_path(run_dir)
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            os.fchmod(f.fileno(), 0o600)
+            for key, value in environment.items():
+                if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', key):
+                    f.write(f'export {key}={shlex.quote(value)}\n')
+                else:
+                    self.stack.logger.warning('%s is not a valid variable name, not passed to the stack', key)
+        return path
+
+    async def _launch(self, specs: List[ServiceSpec]) -> List[ServiceResult]:
+        loop = asyncio.get_running_loop()
+        launched = loop.time()
+        done = {spec.name: asyncio.Event() for spec in specs}
+        results: Dict[str, ServiceResult] = {}
+
+        async def bring_up(spec: ServiceSpec):
+            try:
+                for name in spec.depends_on:
+                    if name in done:
+                        await done[name].wait()
+                failed = [name for name in spec.depends_on if name in results and not results[name].ok]
+                if failed:
+                    results[spec.name] = ServiceResult(spec.name, False, 0.0, 0.0,
+                                                       f'not started, {", ".join(failed)} failed')
+                    return
+                started = loop.time()
+                perf_start = time.perf_counter()
+                try:
+                    panes = await asyncio.to_thread(self._open_window, spec)
+                    ready = await self._wait_ready(spec, panes)
+                    results[spec.name] = ServiceResult(spec.name, True, started - launched, ready)
+                except StackError as e:
+                    results[spec.name] = ServiceResult(spec.name, False, started - launched,
+                                                       loop.time() - started, str(e))
+                self.stack.profiler.record(f'service {spec.name}', 'phase', perf_start,
+                                           time.perf_counter() - perf_start, ok=results[spec.name].ok)
+            finally:
+                done[spec.name].set()
+
+        await asyncio.gather(*(bring_up(spec) for spec in specs))
+        return [results[spec.name] for spec in specs]
+
+    def _open_window(self, spec: ServiceSpec) -> List[str]:
+        """
+        opens the service's window, splits it into its panes and types each pane's commands
+        :rtype: List[str]
+        :return: ids of the panes commands were sent to
+        """
+        (directory, commands), *rest = spec.panes
+        window_id, pane_id = self.tmux('new-window', '-d', '-P', '-F', '#{window_id} #{pane_id}',
+                                       '-t', f'{self.session}:', '-n', spec.name, '-c', directory).split()
+        panes = [(pane_id, commands)]
+        for directory, commands in rest:
+            panes.append((self.tmux('split-window', '-d', '-P', '-F', '#{pane_id}', '-t', window_id, '-c', directory),
+                          commands))
+            self.tmux('select-layout', '-t', window_id, 'tiled')  # keeps room for the next split
+        if spec.layout:
+            self.tmux('select-layout', '-t', window_id, str(spec.layout))
+        for pane_id, commands in panes:
+            for command in [f'. {shlex.quote(self.env_script)}', *commands]:
+                self.tmux('send-keys', '-t', pane_id, '-l', command, ';', 'send-keys', '-t', pane_id, 'Enter')
+        return [pane_id for pane_id, commands in panes if commands]
+
+    async def _probe(self, ready: dict) -> bool:
+        if 'port' in ready:
+            return await can_connect(int(ready['port']), host=ready.get('host', '127.0.0.1'))
+        result = await asyncio.to_thread(self.stack.http.probe, ready['url'], 'GET', 2.0)
+        return result.error is None and 0 < result.status < 500
+
+    def _running(self, panes: List[str]) -> Set[str]:
+        """
+        :rtype: Set[str]
+        :return: the panes running something other than their shell
+        """
+        return {pane_id for pane_id in panes
+                if self.tmux('display-message', '-p', '-t', pane_id, '#{pane_current_command}')
+                not in StackLauncher.SHELLS}
+
+    def _tail(self, panes: List[str], lines: int = 10) -> str:
+        output = []
+        for pane_id in panes:
+            try:
+                captured = self.tmux('capture-pane', '-p', '-t', pane_id, '-S', f'-{lines * 3}')
+            except StackError:
+                continue
+            output += [line for line in captured.splitlines() if line.strip()][-lines:]
+        return '\n'.join(output)
+
+    async def _wait_ready(self, spec: ServiceSpec, panes: List[str]) -> float:
+        """
+        polls the readiness probe with backoff, a service without one is ready once its commands are typed
+        :rtype: float
+        :return: seconds until ready
+        :exception StackError: timed out, or the command ended before the service was ready
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if not spec.ready:
+            return 0.0
+        delay = 0.05
+        seen: Set[str] = set()
+        at_shell = 0
+        while True:
+            if await self._probe(spec.ready):
+                return loop.time() - start
+            elapsed = loop.time() - start
+            # shells can take seconds to start, so a pane only counts as exited once its command was seen running
+            running = await asyncio.to_thread(self._running, panes)
+            seen |= running
+            at_shell = at_shell + 1 if seen and not running & seen else 0
+            if at_shell >= 2 or elapsed >= spec.timeout:
+                reason = 'exited before it was ready' if at_shell >= 2 else f'not ready after {spec.timeout:g}s'
+                tail = await asyncio.to_thread(self._tail, panes)
+                raise StackError(f'{reason}{":" if tail else ""}\n{tail}'.rstrip())
+            await asyncio.sleep(min(delay, spec.timeout - elapsed))
+            delay = min(delay * 2, 0.5)
+
+    def report(self, results: List[ServiceResult]):
+        """
+        logs each service's start and ready time, failures with the end of their pane output
+        :rtype: void
+        """
+        logger = self.stack.logger
+        for result in sorted(results, key=lambda result: (not result.ok, result.started + result.ready)):
+            if result.ok:
+                logger.info('%s: ready in %.0f ms, started %.0f ms after launch',
+                            result.name, result.ready * 1000, result.started * 1000)
+            else:
+                logger.error('%s: %s', result.name, result.detail)
+        usable = max((result.started + result.ready for result in results if result.ok), default=0.0)
+        up = sum(result.ok for result in results)
+        log = logger.info if up == len(results) else logger.warning
+        log('%d/%d services up, stack usable %.0f ms after launch', up, len(results), usable * 1000)
 
 
 class LocalStack:
 
-    def __init__(self):
-        # Load config
-        if not os.path.exists('dod-stack-config/config.json'):
-            raise Exception('Config file not found')
-        with open('dod-stack-config/config.json','r') as f:
-            self.config = json.load(f)
-        self.dod_root = os.environ.get(self.config['DOD_ROOT'])
+    MANAGED_LABEL = 'dod-stack.managed'
+    TMUX_SESSION = 'DOD_Stack'
+    DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dod-stack-config', 'config.json')
+    _instances = itertools.count(1)
+
+    def __init__(self, config_path: Optional[str] = None, env_name: Optional[str] = None, interactive: bool = True,
+                 log_stream=None):
+        """
+        :param config_path: config.json to use, dod-stack-config/config.json next to this script by default
+        :param env_name: env to check and ssh to, env_name from config by default
+        :param interactive: prompt for the envs, when False env_name is used and nothing waits on input
+        :param log_stream: stream the log goes to, stdout by default
+        :exception StackError: config file not found
+        """
+        self.context = StackContext(config_path or LocalStack.DEFAULT_CONFIG)
+        self.config = self.context.config
+        config_dir = self.context.config_dir
+        self.interactive = interactive
+        self.dod_root = self.context.dod_root
         self.cont_name = self.config['container_name']
         self.user = getpass.getuser()
         self.cwd = os.getcwd()
-        self.colors = self.config['colors']
-        self.logger = self.setup_logger()
-        self.env_name = self.config['env_name']
+        log_stream = log_stream or sys.stdout
+        # escape codes only for a terminal, piped or redirected output stays plain
+        self.color = log_stream.isatty() and 'NO_COLOR' not in os.environ
+        self.colors = self.config['colors'] if self.color else {name: '' for name in self.config['colors']}
+        self.log_pipeline = LogPipeline(logging.getLogger(f'{__name__}.{next(LocalStack._instances)}'))
+        self.logger = self.setup_logger(log_stream)
+        self.env_name = env_name or self.config['env_name']
         self.environments = self.config['environments']
+        self.profiler = Profiler()
+        self.keep_warm = bool(self.config.get('keep_warm', False))
+        self._started: Set[str] = set()
+        self.http = HttpProbe()
+        self.docker = DockerClient(DockerClient.socket_from_env(self.config.get('docker_socket', '/var/run/docker.sock')))
+        self._check_local = threading.local()
+        self.redis = self.config.get('redis', {})
+        self.redis_port = int(self.redis.get('port', 6379))
+        self._redis_image_id: Optional[str] = None
+        self.service_results: List[ServiceResult] = []
+        self.self_update_stamp = os.path.join(config_dir, '.self-update')
+        self.tunnels = SshTunnels(os.path.abspath(os.path.expanduser(self.config.get('run_dir', '~/.cache/dod-stack'))),
+                                  self.profiler)
+        self.cache = CheckCache(os.path.join(config_dir, '.check-cache.json'),
+                                self.config.get('check_ttl', {}), self.context.watched)
 
-    def get_valid_ports(self) -> List:
+    def probe_timeout(self, check: str) -> float:
         """
-        fetches all the ports from config
-        fetches all the ports from config
+        per check probe timeout from config
+        :param check: name of the check (vpn or env)
+        :rtype: float
+        :return: timeout in seconds
+        """
+        return float(self.config.get('probe_timeouts', {}).get(check, self.http.timeout))
+
+    def raise_if_abandoned(self, what: str):
+        """
+        stops a check thread from starting new work after run_checks gave up on it
+        :param what: description of the work about to start
+        :rtype: void
+        :exception ChecksAbandoned: the calling check was abandoned
+        """
+        cancelled = getattr(self._check_local, 'cancelled', None)
+        if cancelled is not None and cancelled.is_set():
+            raise ChecksAbandoned(what)
+
+    def get_valid_ports(self, env_name: Optional[str] = None) -> List:
+        """
+        fetches the LocalForward ports of an env (env_name by default) from the ssh config
         :rtype: List
         :return: return a List of valid ports
+        :exception StackError: ssh config not found
         """
-        ssh_config_path = os.path.expanduser(self.config['ssh_config_path'])
-        valid_ports = []
-
-        if os.path.exists(ssh_config_path):
-            with open(ssh_config_path, 'r') as ssh_config_file:
-                lines = ssh_config_file.readlines()
-                inside_host_block = False
-                local_forwards = []
-
-                for line in lines:
-                    line = line.strip()
-                    if line.startswith('Host '):
-                        if inside_host_block and self.env_name in host_line:
-                            valid_ports.extend(local_forwards)
-                            local_forwards = []
-                        host_line = line
-                        if self.env_name in line:
-                            inside_host_block = True
-                        else:
-                            inside_host_block = False
-                    elif inside_host_block and line.startswith('LocalForward '):
-                        tokens = line.split()
-                        local_forward_port = int(tokens[1])
-                        local_forwards.append(local_forward_port)
-
-                # Add local forwards from the last host block if needed
-                if inside_host_block and self.env_name in host_line:
-                    valid_ports.extend(local_forwards)
-        else:
-            self.logger.error(f'{self.colors["RED"]}~/.ssh/config file not found{self.colors["NC"]}')
-            self.clean_up()
-            sys.exit(1)
+        return self.context.ssh_config.local_forwards(env_name or self.env_name)
+
+    def tunnel_ports(self, env_names: List[str]) -> Dict[str, List[int]]:
+        """
+        LocalForward ports per env, each env is its own port namespace
+        :rtype: Dict[str, List[int]]
+        """
+        return {env_name: self.get_valid_ports(env_name) for env_name in env_names}
+
+    def tunnels_up(self, env_names: List[str]) -> bool:
+        """
+        Starts tunnels for several environments at once after checking their ports can't clash
+        envs that already have a tunnel of ours are left as they are
+        :param env_names: envs from config environments
+        :rtype: bool
+        :return: True if every env has a running tunnel
+        """
+        unknown = [env_name for env_name in env_names if env_name not in self.environments]
+        if unknown:
+            self.logger.error('Unknown env %s, please mention %s', ', '.join(unknown), ' or '.join(self.environments))
+            return False
+        ssh_config = self.context.ssh_config
+        running = self.tunnels.tracked()
+        to_start = [env_name for env_name in env_names if env_name not in running]
+        for env_name in env_names:
+            if env_name in running:
+                self.logger.warning('ssh to %s is running skipping', env_name)
+
+        clashes = self.tunnels.clashes(to_start, ssh_config)
+        for clash in clashes:
+            self.logger.error('Port clash: %s', clash)
+        if clashes or not to_start:
+            return not clashes
+
+        self.logger.info('Starting ssh %s', ' '.join(to_start))
+        self.log_pipeline.flush()  # ssh may ask for a passphrase on the terminal
+        with self.profiler.phase('ssh start', envs=to_start):
+            pids = self.tunnels.up(to_start)
+        for env_name, pid in pids.items():
+            if pid is None:
+                self.logger.error('ssh to %s failed', env_name)
+            else:
+                self._started.add(f'tunnel:{env_name}')
+        return all(pid is not None for pid in pids.values())
+
+    def tunnels_down(self, env_names: List[str]):
+        """
+        Stops our tunnels for env_names, the rest of the stack keeps running
+        :rtype: void
+        """
+        for env_name in env_names:
+            if self.tunnels.stop(env_name):
+                self.logger.info('Stopped ssh %s', env_name)
+            else:
+                self.logger.warning('No ssh tunnel to %s running', env_name)
 
-        return valid_ports
+    def tunnels_list(self) -> Dict[str, dict]:
+        """
+        Logs every tunnel we manage with its pid and ports
+        :rtype: Dict[str, dict]
+        :return: env name to pid (None if it died) and ports
+        """
+        tunnels = {}
+        for env_name, ports in self.tunnel_ports(self.tunnels.wanted()).items():
+            pid = self.tunnels.pid(env_name)
+            tunnels[env_name] = {'pid': pid, 'ports': ports}
+            state = f'pid {pid}' if pid is not None else 'down'
+            self.logger.info('%s: %s, ports %s', env_name, state, ', '.join(map(str, ports)) or 'none')
+        if not tunnels:
+            self.logger.info('No ssh tunnels running')
+        return tunnels
 
     def compare_pgpass_and_env(self, env_port) -> bool:
         """
         Compare .pgpass and .env
         :param env_port: Port from .env
         :rtype: bool
-        :return: True if port found in .pgpass, False otherwise
+        :return: True if port found in .pgpass
+        :exception StackError: .pgpass not found or port missing from it
         """
-        pgpass_file_path = os.path.expanduser(self.config['pgpass_path'])
-
-        if not os.path.exists(pgpass_file_path):
-            self.logger.error(f'{self.colors["RED"]}~/.pgpass file not found{self.colors["NC"]}')
-            self.clean_up()
-            sys.exit(1)
-
-        with open(pgpass_file_path, 'r') as pgpass_file:
-            for line in pgpass_file:
-                fields = line.strip().split(':')
-                if len(fields) >= 5:
-                    pgpass_host = fields[0]
-                    pgpass_port = int(fields[1])
-
-                    # Compare only if the host is "localhost" and port matches the env_port
-                    if pgpass_host == 'localhost' and pgpass_port == env_port:
-                        self.logger.info(
-                            f'{self.colors["GREEN"]}Port {pgpass_port} found in .pgpass{self.colors["NC"]}')
-                        return True
+        # Compare only if the host is "localhost" and port matches the env_port
+        if self.context.pgpass.has_port('localhost', env_port):
+            self.logger.info('Port %s found in .pgpass', env_port)
+            return True
 
-        self.logger.error(f'{self.colors["RED"]}Port {env_port} not found in .pgpass{self.colors["NC"]}')
-        self.clean_up()
-        sys.exit(1)
+        raise StackError(f'Port {env_port} not found in .pgpass')
 
     def check_pgpass_env_ssh(self):
         """
-        Goes into .env and checks with the ssh config if it's up-to-date
-        :rtype: None
-        :return: null
+        Checks .env against the ssh config and .pgpass
+        :rtype: bool
+        :return: True once the ports agree
+        :exception StackError: a file is missing or the ports disagree
         """
-        try:
-            os.chdir(f'{self.dod_root}/dod-stack')
-        except FileNotFoundError:
-            self.logger.error(f'{self.colors["RED"]}No dod-stack repo or file exiting{self.colors["NC"]}')
-            self.clean_up()
-            sys.exit(1)
+        cache_key = f'pgpass_env_ssh:{self.env_name}'
+        if self.cache.fresh(cache_key):
+            self.logger.debug('.env, .pgpass and ssh config unchanged, skipping')
+            return True
+        if self.context.stack_dir and not os.path.isdir(self.context.stack_dir):
+            raise StackError('No dod-stack repo or file exiting')
 
-        if not os.path.exists(f'{self.dod_root}/dod-stack/.env'):
-            self.logger.error(
-                f'{self.colors["RED"]} {self.dod_root}/dod-stack/.env file not found{self.colors["NC"]}')
-            self.clean_up()
-            sys.exit(1)
+        raw_port = self.context.env_file.get('DATABASE_PORT_OPS_DOD_MART')
+        if raw_port is None:
+            raise StackError('DATABASE_PORT_OPS_DOD_MART not found in .env')
 
-        with open('.env', 'r') as f:
-            for line in f:
-                line = line.strip()  # Remove leading/trailing whitespaces
+        if not raw_port.strip().isdigit():
+            raise StackError(f'DATABASE_PORT_OPS_DOD_MART={raw_port} is not a port number')
+        env_port = int(raw_port)
+        self.logger.info('Found line: DATABASE_PORT_OPS_DOD_MART=%s', raw_port)
+        self.logger.info('Extracted port: %s', env_port)
 
-                # Skip comments and empty lines
-                if line.startswith('#') or not line:
-                    continue
+        valid_ports = self.get_valid_ports()
 
-                if 'DATABASE_PORT_OPS_DOD_MART' in line:
-                    env_port = int(line.split('=')[1].strip())
-                    self.logger.info(f'{self.colors["GREEN"]}Found line: {line}{self.colors["NC"]}')
-                    self.logger.info(f'{self.colors["GREEN"]}Extracted port: {env_port}{self.colors["NC"]}')
-
-                    valid_ports = self.get_valid_ports()
-
-                    if env_port in valid_ports:
-                        if self.compare_pgpass_and_env(env_port):
-                            self.logger.info(
-                                f'{self.colors["GREEN"]}Valid port found {env_port} in SSH config, .env, and .pgpass{self.colors["NC"]}')
-                            return True
-                        else:
-                            self.logger.error(
-                                f'{self.colors["RED"]}Port in .env does not match .pgpass {env_port}{self.colors["NC"]}')
-                            self.clean_up()
-                            sys.exit(1)
-                    else:
-                        self.logger.error(
-                            f'{self.colors["RED"]}Port in .env does not match any valid ports{self.colors["NC"]}')
-                        self.clean_up()
-                        sys.exit(1)
+        if env_port in valid_ports:
+            if self.compare_pgpass_and_env(env_port):
+                self.logger.info('Valid port found %s in SSH config, .env, and .pgpass', env_port)
+                self.cache.mark(cache_key)
+                return True
+            raise StackError(f'Port in .env does not match .pgpass {env_port}')
+        raise StackError(f'Port {env_port} in .env does not match any valid ports of {self.env_name}')
 
-                    break
-            else:
-                self.logger.error(
-                    f'{self.colors["RED"]}DATABASE_PORT_OPS_DOD_MART not found in .env{self.colors["NC"]}')
-                self.clean_up()
-                sys.exit(1)
+    def validate_all(self) -> bool:
+        """
+        Cross-checks every *_PORT* key in .env against .pgpass and the LocalForward ports of the selected env,
+        reading each file once and reporting all mismatches together;
+        envs have their own ports, so for the other envs the keys they don't forward are only listed
+        :rtype: bool
+        :return: True if nothing mismatched
+        """
+        start = time.perf_counter()
+        if not self.dod_root:
+            self.logger.error('env variable DOD_ROOT not set')
+            return False
+        missing = [path for path in self.context.files() if not os.path.exists(path)]
+        if missing:
+            for path in missing:
+                self.logger.error('%s file not found', path)
+            return False
+
+        env_file = self.context.env_file
+        pgpass = self.context.pgpass
+        ssh_config = self.context.ssh_config
+        forwarded = {env_name: set(ssh_config.local_forwards(env_name)) for env_name in self.environments}
+        parsed = time.perf_counter()
 
-    def setup_logger(self) -> logging.Logger:
+        mismatches = []
+        uncovered: Dict[str, List[str]] = {env_name: [] for env_name in forwarded}
+        if self.env_name not in forwarded:
+            mismatches.append(f'{self.env_name} is not one of the configured environments')
+        port_keys = env_file.port_keys()
+        for key, raw_port in sorted(port_keys.items()):
+            if not raw_port.isdigit():
+                mismatches.append(f'{key}={raw_port} is not a port number')
+                continue
+            port = int(raw_port)
+            if not pgpass.has_port('localhost', port):
+                mismatches.append(f'{key}={port} has no localhost entry in .pgpass')
+            for env_name, ports in forwarded.items():
+                if port not in ports:
+                    uncovered[env_name].append(key)
+            if self.env_name in forwarded and port not in forwarded[self.env_name]:
+                mismatches.append(f'{key}={port} is not forwarded by ssh config for {self.env_name}')
+        for env_name, ports in forwarded.items():
+            if not ports:
+                mismatches.append(f'{env_name} has no LocalForward ports in ssh config')
+        done = time.perf_counter()
+
+        for env_name, keys in uncovered.items():
+            if env_name != self.env_name and keys and forwarded[env_name]:
+                self.logger.info('%s does not forward %s', env_name, ', '.join(keys))
+        for mismatch in mismatches:
+            self.logger.error(mismatch)
+        summary = (f'Validated {len(port_keys)} port keys against {self.env_name}: '
+                   f'{len(mismatches)} mismatches in {(done - start) * 1000:.1f} ms '
+                   f'(parsing {(parsed - start) * 1000:.1f} ms)')
+        if mismatches:
+            self.logger.error(summary)
+            return False
+        self.logger.info(summary)
+        return True
+
+    def setup_logger(self, stream=sys.stdout) -> logging.Logger:
         """
-        Setting up logging
+        Setting up logging, records go through log_pipeline to the stream and the log_file from config if set
+        :param stream: stream the log is written to
         :return: formatted logger
         :rtype: logging.Logger
         """
-        logger = logging.getLogger(__name__)
-        # Setting logging colors
-        log_colors = {
-            logging.DEBUG: self.colors["BLUE"],
-            logging.INFO: self.colors["GREEN"],
-            logging.WARNING: self.colors["AMBER"],
-            logging.ERROR: self.colors["RED"],
-            logging.CRITICAL: self.colors["RED"]
-        }
+        logger = self.log_pipeline.logger
         log_format = '%(asctime)s - %(levelname)s : %(message)s'
         date_format = '%d-%m-%Y %H:%M:%S'
-        # Set level and message color
-        for level, color in log_colors.items():
-            logging.addLevelName(level, color + logging.getLevelName(level) + self.colors["NC"])
-
-        formatter = logging.Formatter(fmt=log_format, datefmt=date_format)
-        # Set different colors for asctime based on the logging level
-        formatter.formatTime = lambda record, date_fmt=date_format: f'{log_colors[record.levelno]}{time.strftime(date_fmt, time.localtime(record.created))}{self.colors["NC"]}'
         logger.setLevel(logging.DEBUG)
-        console_handler = logging.StreamHandler(sys.stdout)
-        logger.addHandler(console_handler)
-        console_handler.setFormatter(formatter)
+        logger.propagate = False
+        console_handler = logging.StreamHandler(stream)
+        if self.color:
+            console_handler.setFormatter(ColorFormatter(self.colors, fmt=log_format, datefmt=date_format))
+        else:
+            console_handler.setFormatter(logging.Formatter(fmt=log_format, datefmt=date_format))
+        console_handler.addFilter(self.log_pipeline.console_filter)
+        handlers = [console_handler]
+        log_file = self.config.get('log_file', {})
+        if log_file.get('path'):
+            path = os.path.join(self.context.config_dir, os.path.expanduser(log_file['path']))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=int(log_file.get('max_bytes', 5 * 1024 * 1024)),
+                backupCount=int(log_file.get('backup_count', 3)), encoding='utf-8', delay=True)
+            file_handler.setLevel(log_file.get('level', 'DEBUG').upper())
+            file_handler.setFormatter(JsonLinesFormatter())
+            handlers.append(file_handler)
+        self.log_pipeline.configure(*handlers)
         return logger
 
-    @staticmethod
-    def update_pip():
+    def self_update(self) -> bool:
         """
-        Update pip
-        :rtype: void
+        Upgrades pip and the optional tqdm progress bar, at most once per self_update_interval_hours
+        :return: True if the upgrade ran and succeeded or wasn't due yet
+        :rtype: bool
         """
-        subprocess.run('pip install --upgrade pip -q', shell=True)
+        interval = float(self.config.get('self_update_interval_hours', 24)) * 3600
+        try:
+            age = time.time() - os.path.getmtime(self.self_update_stamp)
+        except OSError:
+            age = None
+        if age is not None and age < interval:
+            self.logger.info('Dependencies updated %.1fh ago, skipping', age / 3600)
+            return True
+
+        self.logger.info('Updating pip and tqdm')
+        if self.profiler.run([sys.executable, '-m', 'pip', 'install', '--upgrade', 'pip', 'tqdm', '-q']).returncode != 0:
+            self.logger.error('pip upgrade failed')
+            return False
+        with open(self.self_update_stamp, 'w'):
+            pass
+        return True
 
     def check_env(self):
         """
         Checks if the environment is up or not
         :return: True if environment is active
         :rtype: bool
-        :exception subprocess.TimeoutExpired: if the curl command times out
         :exception KeyboardInterrupt: catching ^c
         """
 
         try:
             if self.env_name in self.environments:
                 url = self.environments[self.env_name]
-                with tqdm(total=100, desc=f'{self.colors["BLUE"]}Checking {self.env_name} environment',
+                with progress_bar(total=100, desc=f'{self.colors["BLUE"]}Checking {self.env_name} environment',
                           bar_format='{l_bar}{bar:10}{r_bar}') as pbar:
-                    output = subprocess.run(f'curl -s -o /dev/null -w "%{{http_code}}" -I {url}', timeout=10, shell=True, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                    status_code = int(output.stdout.decode().strip())
-                    if status_code == 404 or status_code == 500 or status_code == 502 or status_code == 503 or status_code == 0:
+                    result = self.http.probe(url, timeout=self.probe_timeout('env'),
+                                             cancelled=getattr(self._check_local, 'cancelled', None))
+                    if result.status in (0, 404, 500, 502, 503):
                         pbar.set_description(f'{self.colors["RED"]}Checking {self.env_name} environment (failed)')
-                        raise Exception(f'{self.colors["RED"]}Checking {self.env_name} environment (failed)')
+                        raise Exception(f'Checking {self.env_name} environment (failed)')
                     else:
-                        pbar.update(50)
-                        time.sleep(1)
-                        pbar.update(50)
-                        pbar.set_description(f'{self.colors["GREEN"]}Checking {self.env_name} environment (success)')
+                        pbar.update(100)
+                        pbar.set_description(
+                            f'{self.colors["GREEN"]}Checking {self.env_name} environment (success, {result.latency * 1000:.0f} ms)')
                         return True
         except KeyboardInterrupt:
             raise
 
     def run_checks(self) -> bool:
         """
-        Runs all the checks concurrently
+        Runs all the checks concurrently, stopping at the first failure, and logs what failed
         :return True if all the checks pass
         :rtype: bool
+        :exception KeyboardInterrupt: catching ^c, the checks' requests are broken off first
+        """
+        results = self.check_results()
+        for result in results:
+            if not result.ok:
+                self.logger.error(result.detail)
+        return all(result.ok for result in results)
+
+    def check_results(self, check_only: bool = False) -> List[CheckResult]:
+        """
+        Runs vpn, environment and docker checks concurrently without logging the outcome
+        :param check_only: run every check to the end, start nothing and cache nothing
+        :return: one result per check in a fixed order, skipped ones are cached and abandoned ones failed
+        :rtype: List[CheckResult]
+        :exception KeyboardInterrupt: catching ^c, the checks' requests are broken off first
+        """
+        with self.profiler.phase('run_checks'):
+            return asyncio.run(self._run_checks_async(check_only))
+
+    async def _run_checks_async(self, check_only: bool = False) -> List[CheckResult]:
+        """
+        Runs vpn, environment and docker checks under one deadline
+        the first failure cancels the rest and breaks off their docker and http requests,
+        with check_only every check runs until it is done or the deadline passes
+        :return: one result per check, vpn, env then docker
+        :rtype: List[CheckResult]
         """
+        deadline = float(self.config.get('checks_deadline', 15))
+        cancelled = threading.Event()
+        loop = asyncio.get_running_loop()
+        # own executor, the default one is joined by asyncio.run and would wait for abandoned checks
+        executor = cf.ThreadPoolExecutor(max_workers=3, thread_name_prefix='check')
+        checks = (('vpn', 'vpn_checks', self.vpn_checks), (f'env:{self.env_name}', 'check_env', self.check_env),
+                  ('docker', 'docker_checks', lambda: self.docker_checks(provision=not check_only)))
+        tasks = {}
+        results = []
+        for cache_key, name, check in checks:
+            if self.cache.fresh(cache_key):
+                self.logger.debug('%s passed recently, skipping', name)
+                results.append(CheckResult(name, True, 0.0, 'passed recently', cached=True))
+                continue
+            task = loop.run_in_executor(executor, self._run_check, name, check,
+                                        None if check_only else cache_key, cancelled)
+            tasks[task] = name
+        order = [name for _, name, _ in checks]
+        if not tasks:
+            executor.shutdown(wait=False)
+            return results
+        pending = set(tasks)
+        started = loop.time()
         try:
-            with cf.ThreadPoolExecutor(max_workers=3) as ex:
-                futures = (
-                    ex.submit(self.vpn_checks),
-                    ex.submit(self.check_env),
-                    ex.submit(self.docker_checks)
-                )
-                all_checks = [future.result(timeout = 15) for future in futures]
-            if all(all_checks):
-                return True
+            done, pending = await asyncio.wait(
+                tasks, timeout=deadline, return_when=asyncio.ALL_COMPLETED if check_only else asyncio.FIRST_EXCEPTION)
+            failed = []
+            for task in done:
+                error = task.exception()
+                if isinstance(error, CheckFailed):
+                    failed.append(error.result.name)
+                    results.append(error.result)
+                elif error is not None:
+                    failed.append(tasks[task])
+                    results.append(CheckResult(tasks[task], False, loop.time() - started, plain(error)))
+                else:
+                    results.append(task.result())
+            elapsed = loop.time() - started
+            for task in pending:
+                reason = f'cancelled after {", ".join(failed)} failed' if failed else f'timed out after {deadline:g}s'
+                results.append(CheckResult(tasks[task], False, elapsed, f'{tasks[task]} {reason}'))
+            return sorted(results, key=lambda result: order.index(result.name))
+        finally:
+            if pending:
+                cancelled.set()
+                for task in pending:
+                    task.cancel()
+                self.docker.abort()
+                self.http.abort()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_check(self, name: str, check, cache_key: Optional[str], cancelled: threading.Event) -> CheckResult:
+        """
+        Runs one check on an executor thread, a falsy result counts as a failure
+        :param name: name the result is reported under
+        :param check: the check, called without arguments
+        :param cache_key: name the result is cached under, None to not cache it
+        :param cancelled: set once the orchestrator abandons this run
+        :rtype: CheckResult
+        :exception CheckFailed: check failed or raised
+        """
+        self._check_local.cancelled = cancelled
+        start = time.perf_counter()
+        try:
+            with self.profiler.phase(name):
+                passed = check()
+        except ChecksAbandoned:
+            raise
         except Exception as e:
-            self.logger.error(e)
-            return False
-        except KeyboardInterrupt:
-            self.logger.error(f'\n{self.colors["RED"]}Exiting script...{self.colors["NC"]}')
-            for future in futures:
-                if future.running():
-                    future.cancel()
-            self.clean_up()
-            sys.exit(1)
-        except cf.TimeoutError:
-            return False
+            raise CheckFailed(CheckResult(name, False, time.perf_counter() - start, plain(e)))
+        finally:
+            self._check_local.cancelled = None
+        if not passed:
+            raise CheckFailed(CheckResult(name, False, time.perf_counter() - start, f'{name} failed'))
+        if cache_key is not None:
+            self.cache.mark(cache_key)
+        return CheckResult(name, True, time.perf_counter() - start)
+
+    def check(self, validate_all: bool = False) -> dict:
+        """
+        Runs every check plus the .env, .pgpass and ssh config cross-check without starting anything,
+        a failed check doesn't cut the others short
+        :param validate_all: also cross-check every *_PORT* key against every env
+        :return: ok and the result of every check, always in the same order
+        :rtype: dict
+        """
+        results = self.check_results(check_only=True)
+        start = time.perf_counter()
+        try:
+            with self.profiler.phase('check_pgpass_env_ssh'):
+                self.check_pgpass_env_ssh()
+            results.append(CheckResult('check_pgpass_env_ssh', True, time.perf_counter() - start))
+        except StackError as e:
+            results.append(CheckResult('check_pgpass_env_ssh', False, time.perf_counter() - start, plain(e)))
+        if validate_all:
+            start = time.perf_counter()
+            passed = self.validate_all()
+            results.append(CheckResult('validate_all', passed, time.perf_counter() - start,
+                                       '' if passed else 'port mismatches, see log'))
+        for result in results:
+            if result.ok:
+                if result.cached:
+                    self.logger.info('%s: ok (cached)', result.name)
+                else:
+                    self.logger.info('%s: ok (%.0f ms)', result.name, result.duration * 1000)
+            else:
+                self.logger.error('%s: %s', result.name, result.detail)
+        return {'ok': all(result.ok for result in results), 'env': self.env_name,
+                'checks': [result._asdict() for result in results]}
 
     def vpn_checks(self) -> bool:
         """
@@ -278,202 +2421,609 @@ class LocalStack:
         :exception KeyboardInterrupt: catching ^c
         """
         try:
-            if subprocess.run(f'curl -s {self.config["vpn_url"]}', shell=True,
-                              stdout=subprocess.DEVNULL).returncode == 0:
+            result = self.http.probe(self.config['vpn_url'], timeout=self.probe_timeout('vpn'),
+                                     cancelled=getattr(self._check_local, 'cancelled', None))
+            if result.error is None:  # any http response means the vpn routes us through
                 return True
 
             else:
-                time.sleep(1)
-                raise Exception(f'{self.colors["RED"]}VPN is off{self.colors["NC"]}')
+                raise Exception('VPN is off')
         except KeyboardInterrupt:  # trying to catch if somebody presses ^C
             raise
 
-    def docker_checks(self) -> bool:
+    def docker_checks(self, provision: bool = True) -> bool:
         """
         Constantly Check if Docker is running and start Redis container if needed
+        :param provision: start or create the redis container when it isn't running, otherwise only say so
         :return: true is docker on
         :rtype: bool
         :exception KeyboardInterrupt: catching ^c
         """
         try:
-            # check if docker is on
-            if subprocess.run('docker info', shell=True, stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL).returncode != 0:
+            # one api call answers both whether docker is on and what state the container is in
+            try:
+                container = self.docker.find_container(self.cont_name)
+            except (OSError, http.client.HTTPException, DockerError):
                 raise Exception(
-                    f'{self.colors["RED"]}This script uses docker, and it isn\'t running - please start docker{self.colors["NC"]}')
+                    'This script uses docker, and it isn\'t running - please start docker')
 
-            # if docker container found running do nothing
-            elif subprocess.run(f'docker ps -q -f name={self.cont_name} -f status=running', shell=True,
-                                stderr=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout:
-                return True
+            state = container['State'] if container is not None else None
+            if state not in ('running', 'restarting'):
+                if state not in (None, 'exited', 'created'):
+                    raise Exception(
+                        f'Container {self.cont_name} is {state}, please check docker')
+                if not provision:
+                    self.logger.info('Container %s is %s, up starts it', self.cont_name, state or 'missing')
+                    return True
+                self.raise_if_abandoned(f'docker start {self.cont_name}')
+                with self.profiler.phase('redis_start'):
+                    self.provision_redis(container)
 
-            elif subprocess.run(f'docker ps -q -f name={self.cont_name} -f status=exited', shell=True,
-                                stderr=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout:
-                # Check if Redis container is exited, start if needed
-                subprocess.run(f'docker start {self.cont_name}', shell=True, stdout=subprocess.DEVNULL)
-                return True
-            elif subprocess.run(f'docker ps -q -f name={self.cont_name} -f status=created', shell=True,
-                                stderr=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout:
-                self.clean_up()
-                subprocess.run(
-                    f'docker run --name {self.cont_name} -d -p 127.0.0.1:6379:6379 {self.cont_name}:latest',
-                    shell=True, stdout=subprocess.DEVNULL)
-                return True
-            else:
-                subprocess.run(
-                    f'docker run --name {self.cont_name} -d -p 127.0.0.1:6379:6379 {self.cont_name}:latest',
-                    shell=True, stdout=subprocess.DEVNULL)
-                return True
+            timeout = float(self.redis.get('ready_timeout', 10))
+            with self.profiler.phase('redis_ready'):
+                elapsed = self.wait_for_redis(timeout)
+            if elapsed is None:
+                raise Exception(f'Redis on port {self.redis_port} did not answer PING within {timeout:g}s')
+            self.logger.debug('Redis ready in %.0f ms', elapsed * 1000)
+            return True
         except KeyboardInterrupt:  # trying to catch if somebody presses ^C
             raise
 
-    def ssh_env(self) -> None:
+    def redis_image_id(self, pull: bool = False) -> str:
         """
-        Constantly checks for ssh params
-        :rtype: void or exit
-        :exception KeyboardInterrupt: catching ^c
+        id of the redis image, looked up once per run
+        :param pull: pull the image if the daemon doesn't have it, never from a check as its deadline would cut it short
+        :rtype: str
+        :exception StackError: image missing and not pulled
+        :exception DockerError: pull failed
         """
-        while True:
-            if self.run_checks():
-                if self.dod_root:
-                    if not LocalStack.is_ssh_running():  # when ssh not running start ssh
-                        try:
-                            valid = False
-                            while not valid:
-                                envs = '\n'.join(self.environments.keys())
-                                invalid_envs = ' or '.join(self.environments.keys())
-                                self.env_name = input(
-                                    f'{self.colors["VIOLET"]}Please enter the env you want to ssh to:\n{envs}\n{self.colors["NC"]}').strip().lower()
-                                if self.env_name in self.environments:
-                                    valid = True
-                                    self.logger.info(
-                                        f'{self.colors["GREEN"]}Starting ssh {self.env_name}{self.colors["NC"]}')
-                                    subprocess.run(f'ssh -fN {self.env_name}', shell=True)
-                                    if LocalStack.is_ssh_running():
-                                        break
-                                else:
-                                    self.logger.error(
-                                        f'{self.colors["RED"]}Invalid argument \'{self.env_name}\' please mention {invalid_envs} pls enter again{self.colors["NC"]}')
-
-                        except KeyboardInterrupt:  # trying to catch if somebody presses ^C
-                            self.logger.error(f'\n{self.colors["RED"]}Exiting script...{self.colors["NC"]}')
-                            self.clean_up()
-                            sys.exit(1)
+        if self._redis_image_id is None:
+            image = self.redis.get('image', f'{self.cont_name}:latest')
+            image_id = self.docker.image_id(image)
+            if image_id is None and pull:
+                self.logger.info('Pulling %s', image)
+                repository, _, tag = image.rpartition(':')
+                self.docker.pull(repository or image, tag if repository else 'latest',
+                                 timeout=float(self.redis.get('pull_timeout', 300)))
+                image_id = self.docker.image_id(image)
+            if image_id is None:
+                raise StackError(f'Redis image {image} is missing, run docker pull {image}')
+            self._redis_image_id = image_id
+        return self._redis_image_id
 
-                    else:
-                        self.logger.warning(
-                            f'{self.colors["AMBER"]}ssh is running skipping{self.colors["NC"]}')  # if ssh session open then skip
-                        break
-                else:
-                    self.logger.error(f'{self.colors["RED"]}env variable DOD_ROOT not set{self.colors["NC"]}')
-                    self.clean_up()
-                    sys.exit(1)
+    def pull_redis_image(self):
+        """
+        Pulls the redis image ahead of the checks when there is no container to start and the daemon lacks it,
+        the pull gets redis.pull_timeout seconds instead of whatever is left of checks_deadline;
+        an unreachable daemon or a failed pull is left for docker_checks to report
+        :rtype: void
+        """
+        try:
+            if self._redis_image_id is not None or self.docker.find_container(self.cont_name) is not None:
+                return
+        except (OSError, http.client.HTTPException, DockerError):
+            return
+        try:
+            self.redis_image_id(pull=True)
+        except (OSError, http.client.HTTPException, DockerError, StackError) as e:
+            self.logger.warning('Pulling the redis image failed: %s', e)
+
+    def provision_redis(self, container: Optional[dict]):
+        """
+        starts a stopped or created container as it is, otherwise creates ours from the cached image id
+        with snapshot_volume set /data is that named volume and redis saves an rdb snapshot to it,
+        so a recreated container comes up with the data of the last one
+        :param container: existing container summary or None
+        :rtype: void
+        """
+        if container is not None:
+            self.docker.start(container['Id'])
+        else:
+            volume = self.redis.get('snapshot_volume')
+            self.docker.run(self.cont_name, self.redis_image_id(), {'6379/tcp': ('127.0.0.1', self.redis_port)},
+                            {LocalStack.MANAGED_LABEL: 'true'},
+                            binds=[f'{volume}:/data'] if volume else None,
+                            cmd=['redis-server', '--save', '60', '1'] if volume else None)
+        self._started.add('redis')
+
+    @staticmethod
+    def redis_ping(port: int, timeout: float, host: str = '127.0.0.1') -> bool:
+        """
+        :rtype: bool
+        :return: True if redis answered PONG, it answers LOADING while it reads a snapshot
+        """
+        try:
+            with socket.create_connection((host, port), timeout=timeout) as sock:
+                sock.sendall(b'PING\r\n')
+                return sock.recv(64).startswith(b'+PONG')
+        except OSError:
+            return False
+
+    def wait_for_redis(self, timeout: float) -> Optional[float]:
+        """
+        Sends PING with exponential backoff until redis answers or timeout passes
+        :param timeout: seconds to wait
+        :rtype: float
+        :return: seconds until redis answered or None if it didn't
+        :exception ChecksAbandoned: the check was abandoned while waiting
+        """
+        start = time.perf_counter()
+        deadline = start + timeout
+        delay = 0.01
+        while True:
+            self.raise_if_abandoned('redis PING')
+            if LocalStack.redis_ping(self.redis_port, min(1.0, max(deadline - time.perf_counter(), 0.05))):
+                return time.perf_counter() - start
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.25)
 
-    def stack_up(self) -> None:
+    def prompt_envs(self) -> List[str]:
         """
-        final checks
-        :exception subprocess.CalledProcessError: package error
-        :exception FileNotFoundError: repo or file not found
+        Asks for the envs to ssh to until only known ones are given
+        :return: env names, the first one is the env checked
+        :rtype: List[str]
         :exception KeyboardInterrupt: catching ^c
+        """
+        envs = '\n'.join(self.environments.keys())
+        invalid_envs = ' or '.join(self.environments.keys())
+        while True:
+            self.log_pipeline.flush()
+            answer = input(
+                f'{self.colors["VIOLET"]}Please enter the env you want to ssh to (several separated by spaces):\n{envs}\n{self.colors["NC"]}').strip().lower()
+            env_names = [env_name for env_name in re.split(r'[\s,]+', answer) if env_name]
+            invalid = [env_name for env_name in env_names if env_name not in self.environments]
+            if env_names and not invalid:
+                return env_names
+            self.logger.error(
+                "Invalid argument '%s' please mention %s pls enter again", ' '.join(invalid) or answer, invalid_envs)
+
+    def ssh_env(self, env_names: Optional[List[str]] = None) -> None:
+        """
+        Constantly checks for ssh params then starts the tunnels
+        the envs are prompted for unless given, when not interactive env_name is used and failures raise
+        :param env_names: envs to ssh to, the first one is the env checked
         :rtype: void
+        :exception StackError: DOD_ROOT not set, unknown env, or checks or tunnels failed when not interactive
+        :exception KeyboardInterrupt: catching ^c
         """
-        if self.check_pgpass_env_ssh() and self.run_checks():
-            if self.dod_root:
-                try:
-                    os.chdir(f'{self.dod_root}/dod-stack')
-                    subprocess.run('dotenv -e .env tmuxp load dod-stack.yaml', shell=True, check=True,
-                                   stderr=subprocess.DEVNULL)
-                except FileNotFoundError:  # catching if file or repo doesn't exist or env variable doesn't exist
-                    self.logger.error(f'{self.colors["RED"]}No dod-stack repo or file exiting{self.colors["NC"]}')
-                except subprocess.CalledProcessError as e:
-                    self.logger.error(
-                        f'{self.colors["RED"]}An error occurred: {e}\ninstall pip dependencies from dod-stack repo:\ncd $DOD_ROOT/dod-stack\npip install -r requirements.txt{self.colors["NC"]}')
-                except KeyboardInterrupt:  # trying to catch if somebody presses ^C
-                    self.logger.error(f'\n{self.colors["RED"]}Exiting script...{self.colors["NC"]}')
+        unknown = [env_name for env_name in env_names or [] if env_name not in self.environments]
+        if unknown:
+            raise StackError(f'Unknown env {" ".join(unknown)}, please mention {" or ".join(self.environments)}')
+        if env_names:
+            self.env_name = env_names[0]
+        while True:
+            with self.profiler.phase('redis_pull'):
+                self.pull_redis_image()
+            if not self.run_checks():
+                if not self.interactive:
+                    raise StackError('Checks failed')
+                time.sleep(1)  # the checks fail fast, don't spin while the vpn or docker comes up
+                continue
+            if not self.dod_root:
+                raise StackError('env variable DOD_ROOT not set')
+            if not env_names and self.is_ssh_running():
+                self.logger.warning('ssh is running skipping')  # if ssh session open then skip
+                return
+            wanted = env_names or (self.prompt_envs() if self.interactive else [self.env_name])
+            # the first env is the one the environment and .env checks run against
+            self.env_name = wanted[0]
+            if self.tunnels_up(wanted):
+                return
+            if not self.interactive:
+                raise StackError(f'Could not start ssh tunnels to {", ".join(wanted)}')
+            env_names = None
+
+    async def _wait_for_port(self, port: int, deadline: float, host: str = '127.0.0.1') -> Optional[float]:
+        """
+        Retries a short connect to host:port with exponential backoff until it is accepted or deadline passes
+        :param port: local port
+        :param deadline: loop time to give up at
+        :rtype: float
+        :return: seconds until the port accepted a connection, None if it never did
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        delay = 0.05
+        while True:
+            if await can_connect(port, max(min(0.5, deadline - loop.time()), 0.01), host):
+                return loop.time() - start
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    async def _wait_for_ports(self, ports: List[int], timeout: float) -> Dict[int, Optional[float]]:
+        """
+        Probes every port concurrently under one deadline
+        :rtype: Dict[int, Optional[float]]
+        :return: port to time until ready, None for ports that never came up
+        """
+        deadline = asyncio.get_running_loop().time() + timeout
+        ready = await asyncio.gather(*(self._wait_for_port(port, deadline) for port in ports))
+        return dict(zip(ports, ready))
 
+    def wait_for_tunnel(self) -> bool:
+        """
+        Waits for every LocalForward port of our tunnels (env_name if none are tracked) to accept connections
+        :return: True once all the ports are up
+        :rtype: bool
+        """
+        env_names = list(self.tunnels.tracked()) or [self.env_name]
+        ports = sorted({port for env_ports in self.tunnel_ports(env_names).values() for port in env_ports})
+        if not ports:
+            self.logger.warning('No LocalForward ports for %s in ssh config', ', '.join(env_names))
+            return True
+        timeout = float(self.config.get('tunnel_ready_timeout', 10))
+        ready = asyncio.run(self._wait_for_ports(ports, timeout))
+        for port, elapsed in ready.items():
+            if elapsed is None:
+                self.logger.error('Port %s not accepting connections after %gs', port, timeout)
+            else:
+                self.logger.debug('Port %s ready in %.0f ms', port, elapsed * 1000)
+        return all(elapsed is not None for elapsed in ready.values())
+
+    def stack_up(self, detach: bool = False) -> bool:
+        """
+        final checks then loads the tmux session, attached until it is closed unless detached
+        :param detach: load the session in the background and return, no watchdog is run
+        :exception StackError: config mismatch or DOD_ROOT not set
+        :exception KeyboardInterrupt: catching ^c
+        :rtype: bool
+        :return: True if the stack was started
+        """
+        with self.profiler.phase('check_pgpass_env_ssh'):
+            config_ok = self.check_pgpass_env_ssh()
+        if not (config_ok and self.run_checks()):
+            return False
+        if not self.dod_root:
+            raise StackError('env variable DOD_ROOT not set')
+        with self.profiler.phase('wait_for_tunnel'):
+            tunnel_ready = self.wait_for_tunnel()
+        if not tunnel_ready:
+            self.logger.error('ssh tunnel to %s is not ready, not starting the stack', self.env_name)
+            return False
+        watchdog = None if detach else self.watchdog()
+        use_tmuxp = self.use_tmuxp()
+        try:
+            if watchdog is not None:
+                watchdog.start()
+            if use_tmuxp:
+                self._started.add('tmux')
+                with self.log_pipeline.terminal_handed_over() if not detach else contextlib.nullcontext():
+                    self.profiler.run(f'dotenv -e .env tmuxp load {"-d " if detach else ""}dod-stack.yaml',
+                                      shell=True, check=True, stderr=subprocess.DEVNULL, cwd=self.context.stack_dir)
+                return True
+            started = self.launch_services()
+            if not detach:
+                with self.log_pipeline.terminal_handed_over():
+                    self.profiler.run(['tmux', 'attach-session', '-t', LocalStack.TMUX_SESSION], check=True)
+            return started
+        except FileNotFoundError:  # catching if file or repo doesn't exist or env variable doesn't exist
+            self.logger.error('No dod-stack repo or file exiting')
+        except subprocess.CalledProcessError as e:
+            if use_tmuxp:
+                self.logger.error(
+                    'An error occurred: %s\ninstall pip dependencies from dod-stack repo:\ncd $DOD_ROOT/dod-stack\npip install -r requirements.txt', e)
             else:
-                self.logger.error(f'{self.colors["RED"]}env variable DOD_ROOT not set{self.colors["NC"]}')
+                self.logger.error('Could not attach to tmux session %s: %s', LocalStack.TMUX_SESSION, e)
+        except KeyboardInterrupt:  # trying to catch if somebody presses ^C
+            self.logger.error('\nExiting script...')
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+        return False
+
+    def use_tmuxp(self) -> bool:
+        """
+        whether dod-stack.yaml is handed to tmuxp load, as configured or because PyYAML is missing
+        :rtype: bool
+        """
+        if self.config.get('launcher', {}).get('mode', 'panes') == 'tmuxp':
+            return True
+        try:
+            import yaml  # noqa: F401
+        except ImportError:
+            self.logger.warning('PyYAML not installed, starting the stack with tmuxp load')
+            return True
+        return False
+
+    def launch_services(self) -> bool:
+        """
+        Starts the services of dod-stack.yaml in dependency order and reports how each one went
+        :rtype: bool
+        :return: True if every service became ready
+        :exception StackError: the session already exists, or the yaml or tmux failed
+        """
+        has_session = self.profiler.run(['tmux', 'has-session', '-t', LocalStack.TMUX_SESSION],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if has_session.returncode == 0:
+            raise StackError(f'tmux session {LocalStack.TMUX_SESSION} is already running, '
+                             f'attach with tmux attach -t {LocalStack.TMUX_SESSION} or run down first')
+        launcher = StackLauncher(self, LocalStack.TMUX_SESSION, os.path.join(self.context.stack_dir, 'dod-stack.yaml'))
+        self._started.add('tmux')
+        with self.profiler.phase('launch_services'):
+            self.service_results = launcher.launch()
+        launcher.report(self.service_results)
+        return all(result.ok for result in self.service_results)
 
-    def clean_up(self):
+    def watchdog(self) -> Optional[Watchdog]:
         """
-        cleans up docker and ssh session and tmux session
+        Watchdog configured from the watchdog section of config
+        :rtype: Watchdog
+        :return: watchdog or None when disabled
+        """
+        settings = self.config.get('watchdog', {})
+        if not settings.get('enabled', True):
+            return None
+        return Watchdog(self, redis_port=self.redis_port,
+                        min_interval=float(settings.get('min_interval', 2)),
+                        max_interval=float(settings.get('max_interval', 30)),
+                        cpu_budget=float(settings.get('cpu_budget', 0.01)))
+
+    def clean_up(self, owned_only: bool = False):
+        """
+        cleans up tmux session, our ssh tunnels and our redis container concurrently
+        with keep_warm the tunnel and redis are left up so the next launch is near instant
+        :param owned_only: only tear down what this run started, for error paths
         :rtype: void
         """
+        with self.profiler.phase('clean_up', owned_only=owned_only, keep_warm=self.keep_warm):
+            steps = []
+            if not owned_only or 'tmux' in self._started:
+                steps.append(self._kill_tmux_session)
+            if self.keep_warm:
+                self.logger.info('Keeping redis and ssh tunnel warm')
+            else:
+                for env_name in self.tunnels.wanted():
+                    if not owned_only or f'tunnel:{env_name}' in self._started:
+                        steps.append(lambda env_name=env_name: self.tunnels.stop(env_name))
+                if not owned_only or 'redis' in self._started:
+                    steps.append(self._remove_redis)
+            if not steps:
+                return
+            with cf.ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='clean_up') as ex:
+                for future in [ex.submit(step) for step in steps]:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.logger.warning('Clean up step failed: %s', e)
 
-        if LocalStack.get_tmux_session_id():
-            subprocess.run('tmux kill-session -t DOD_Stack', shell=True)
-        ssh_pids = self.get_ssh_pid()
-        for pid in ssh_pids:
-            subprocess.run(f'kill -9 {pid}', shell=True, stdout=subprocess.DEVNULL,
-                       stderr=subprocess.DEVNULL)
-        subprocess.run(f'docker container rm -f {self.cont_name} && docker volume prune -f', shell=True,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def _kill_tmux_session(self):
+        """
+        kills our tmux session, a missing session is not an error
+        :rtype: void
+        """
+        self.profiler.run(['tmux', 'kill-session', '-t', LocalStack.TMUX_SESSION],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            os.remove(StackLauncher.env_script_path(self.tunnels.run_dir))
+        except OSError:
+            pass
 
-    def main(self):
+    def _remove_redis(self):
         """
-        Main function for program
+        removes the containers this tool labelled with their anonymous volumes, nothing global is pruned
         :rtype: void
         """
-        if sys.platform == 'linux':
+        for container in self.docker.find_containers(label=[f'{LocalStack.MANAGED_LABEL}=true']):
+            self.docker.remove(container['Id'])
+        self.cache.invalidate('docker')
+
+    def main(self, env_names: Optional[List[str]] = None, detach: bool = False) -> dict:
+        """
+        Main function for program, checks, opens the tunnels and runs the stack
+        :param env_names: envs to ssh to, prompted for when interactive and not given
+        :param detach: leave the stack running in the background instead of cleaning up when it closes
+        :exception StackError: a check or step failed
+        :return: ok and the envs started
+        :rtype: dict
+        """
+        if sys.platform != 'linux':
+            raise StackError('This script only works on Linux machines or WSL.')
+        if self.interactive:
             # set title of shell
             sys.stdout.write("\x1b]2;DOD-Stack\x07")
-            # prints user and pwd
-            self.logger.debug(f'{self.colors["BLUE"]}You are {self.user} in {self.cwd}{self.colors["NC"]}')
-            LocalStack.update_pip()
-            self.ssh_env()
-            self.stack_up()
+        # prints user and pwd
+        self.logger.debug('You are %s in %s', self.user, self.cwd)
+        with self.profiler.phase('ssh_env'):
+            self.ssh_env(env_names)
+        tunnels = self.tunnels.tracked()
+        with self.profiler.phase('stack_up'):
+            started = self.stack_up(detach)
+        if not detach:
             self.clean_up()
+        return {'ok': started, 'env': self.env_name, 'tunnels': tunnels, 'detached': detach,
+                'services': [result._asdict() for result in self.service_results]}
+
+    def down(self, env_names: Optional[List[str]] = None) -> dict:
+        """
+        Tears down the stack, or only the tunnels of env_names, keep_warm doesn't apply when asked for explicitly
+        :param env_names: envs whose tunnels are stopped, everything when not given
+        :return: ok and the tunnels still running
+        :rtype: dict
+        """
+        if env_names:
+            self.tunnels_down(env_names)
         else:
-            self.logger.error('This script only works on Linux machines or WSL.')
+            self.keep_warm = False
+            self.clean_up()
+        return {'ok': True, 'tunnels': self.tunnels.tracked()}
 
-    @staticmethod
-    def get_tmux_session_id() -> int:
+    def status(self) -> dict:
         """
-        get tmux session id
-        :return: tmux session id
-        :rtype: int
-        :exception subprocess.CallProcessError: no session exception
+        Reports our tunnels, the redis container and the tmux session
+        :return: tunnels, redis container state and whether the tmux session exists
+        :rtype: dict
         """
+        tunnels = self.tunnels_list()
         try:
-            output = subprocess.check_output('tmux ls', shell=True, stderr=subprocess.DEVNULL)
-
-            # Decode the output from bytes to string
-            output = output.decode('utf-8')
-
-            # Split the output into lines
-            lines = output.strip().split('\n')
-
-            # Parse the session ID from the first line of output
-            if len(lines) > 0:
-                session_id = lines[0].split(':')[0]
-                return session_id
-        except subprocess.CalledProcessError:
-            # If no session is found, return 0
-            return 0
+            container = self.docker.find_container(self.cont_name)
+            redis = container['State'] if container else 'missing'
+        except (OSError, http.client.HTTPException, DockerError):
+            redis = 'docker not running'
+        try:
+            tmux = self.profiler.run(['tmux', 'has-session', '-t', LocalStack.TMUX_SESSION],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+        except FileNotFoundError:
+            tmux = False
+        self.logger.info('Redis container %s: %s', self.cont_name, redis)
+        self.logger.info('tmux session %s: %s', LocalStack.TMUX_SESSION, 'running' if tmux else 'not running')
+        return {'ok': True, 'tunnels': tunnels, 'redis': redis, 'tmux_session': tmux}
 
-    @staticmethod
-    def is_ssh_running() -> bool:
+    def is_ssh_running(self) -> bool:
         """
         checks if ssh is running
         :return: ssh running true or false
         :rtype: bool
         """
-        return True if LocalStack.get_ssh_pid() else False
+        return True if self.get_ssh_pid() else False
 
-    @staticmethod
-    def get_ssh_pid() -> List[int]:
+    def get_ssh_pid(self) -> List[int]:
         """
-        gets ssh process id
-        :return: ssh process id
-        :rtype: int
+        gets ssh process ids, our tracked tunnels first, else any ssh connected to port 22
+        :return: ssh process ids
+        :rtype: List[int]
         """
-        process = subprocess.Popen('lsof -t -i:22', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if err:
-            return []
-        return [int(pid) for pid in out.decode().strip().split()] if out else []
+        tracked = list(self.tunnels.tracked().values())
+        return tracked if tracked else SshTunnels.ssh_pids_on_port(22)
+
+
+COMMANDS = ('up', 'check', 'down', 'status', 'tunnels', 'self-update')
+COMMAND_ALIASES = {'--validate-all': ['check', '--all'], '--self-update': ['self-update']}
+
+
+def command_first(argv: List[str]) -> List[str]:
+    """
+    moves the subcommand to the front so the options given before it are parsed by the subcommand,
+    --env dev2 check would otherwise read check as an env; no subcommand means up
+    :rtype: List[str]
+    """
+    command, rest, takes_value = None, [], False
+    for arg in argv:
+        if command is None and not takes_value and (arg in COMMANDS or arg in COMMAND_ALIASES):
+            command = COMMAND_ALIASES.get(arg, [arg])
+        else:
+            rest.append(arg)
+        takes_value = arg in ('--config', '--trace')
+    if command is None and any(arg in ('-h', '--help') for arg in rest):
+        return rest  # the script's own help lists the subcommands
+    return (command or ['up']) + rest
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    command line of the script, run_cli puts the subcommand first so its options are accepted before or after it
+    :rtype: argparse.ArgumentParser
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', metavar='FILE', default=argparse.SUPPRESS,
+                        help='config.json to use instead of dod-stack-config/config.json next to this script')
+    common.add_argument('--json', action='store_true', default=argparse.SUPPRESS,
+                        help='log to stderr and print the result as json on stdout, never prompts')
+    common.add_argument('--profile', action='store_true', default=argparse.SUPPRESS,
+                        help='print how long every phase and command took when exiting')
+    common.add_argument('--trace', metavar='FILE', default=argparse.SUPPRESS,
+                        help='write the phase and command timings to FILE as a chrome trace json')
+    up_options = argparse.ArgumentParser(add_help=False)
+    up_options.add_argument('--env', nargs='+', metavar='ENV', default=argparse.SUPPRESS,
+                            help='envs to ssh to instead of being prompted, the first one is checked')
+    up_options.add_argument('--keep-warm', action='store_true', default=argparse.SUPPRESS,
+                            help='leave the redis container and ssh tunnel up on exit for a fast restart')
+    up_options.add_argument('--detach', action='store_true', default=argparse.SUPPRESS,
+                            help='load the tmux session in the background and exit, leaving the stack up')
+
+    parser = argparse.ArgumentParser(description='Runs a local stack and performs necessary checks.',
+                                     parents=[common])
+    parser.add_argument('--validate-all', action='store_true', help='same as check --all')
+    parser.add_argument('--self-update', action='store_true', help='same as self-update')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.add_parser('up', parents=[common, up_options],
+                        help='run the checks, open the ssh tunnels and run the stack (default)')
+    check = commands.add_parser('check', parents=[common], help='run the checks without starting anything')
+    check.add_argument('--env', metavar='ENV', default=argparse.SUPPRESS, help='env to check instead of env_name')
+    check.add_argument('--all', action='store_true',
+                       help='also check every *_PORT* key in .env against .pgpass and the ssh config of all envs')
+    down = commands.add_parser('down', parents=[common], help='stop the stack, ssh tunnels and redis container')
+    down.add_argument('--env', nargs='+', metavar='ENV', default=argparse.SUPPRESS,
+                      help='only stop the ssh tunnels for ENV')
+    commands.add_parser('status', parents=[common], help='show the ssh tunnels, redis container and tmux session')
+    tunnels = commands.add_parser('tunnels', parents=[common], help='list, add or drop ssh tunnels of a running stack')
+    tunnels.add_argument('action', choices=['list', 'add', 'drop'])
+    tunnels.add_argument('envs', nargs='*', metavar='ENV')
+    commands.add_parser('self-update', parents=[common],
+                        help='upgrade pip and tqdm (at most once per self_update_interval_hours)')
+    return parser
+
+
+def run_cli(argv: Optional[List[str]] = None) -> int:
+    """
+    runs one command line
+    :param argv: arguments, sys.argv by default
+    :return: exit code
+    :rtype: int
+    """
+    args = vars(build_parser().parse_args(command_first(sys.argv[1:] if argv is None else argv)))
+    command = args['command']
+    as_json = args.get('json', False)
+    env_names = args.get('env')
+    if isinstance(env_names, str):
+        env_names = [env_names]
+    try:
+        local = LocalStack(config_path=args.get('config'),
+                           env_name=env_names[0] if env_names else None,
+                           interactive=not as_json and sys.stdin.isatty(),
+                           log_stream=sys.stderr if as_json else sys.stdout)
+    except StackError as e:
+        print(e, file=sys.stderr)
+        return 1
+    local.keep_warm = local.keep_warm or args.get('keep_warm', False)
+
+    try:
+        if command == 'up':
+            result = local.main(env_names, detach=args.get('detach', False))
+        elif command == 'check':
+            result = local.check(validate_all=args.get('all', False))
+        elif command == 'down':
+            result = local.down(env_names)
+        elif command == 'status':
+            result = local.status()
+        elif command == 'tunnels':
+            if args['action'] != 'list' and not args['envs']:
+                raise StackError(f'tunnels {args["action"]} needs at least one env')
+            if args['action'] == 'add':
+                result = {'ok': local.tunnels_up(args['envs'])}
+            elif args['action'] == 'drop':
+                local.tunnels_down(args['envs'])
+                result = {'ok': True}
+            else:
+                result = {'ok': True, 'tunnels': local.tunnels_list()}
+        else:
+            result = {'ok': local.self_update()}
+    except StackError as e:
+        local.logger.error(e)
+        local.clean_up(owned_only=True)
+        result = {'ok': False, 'error': plain(e)}
+    except KeyboardInterrupt:  # trying to catch if somebody presses ^C
+        local.logger.error('\nExiting script...')
+        local.clean_up(owned_only=True)
+        result = {'ok': False, 'error': 'interrupted'}
+    finally:
+        local.log_pipeline.flush()
+        if args.get('profile'):
+            print(local.profiler.summary(), file=sys.stderr)
+        if args.get('trace'):
+            local.profiler.write_trace(args['trace'])
+
+    if as_json:
+        result['command'] = command
+        result['timings'] = local.profiler.totals()
+        print(json.dumps(result, indent=2, default=str))
+    return 0 if result.get('ok') else 1
 
 
 if __name__ == '__main__':
-    local = LocalStack()
-    local.main()
+    sys.exit(run_cli())
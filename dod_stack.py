@@ -0,0 +1,15 @@
+"""
+Importable name for dod-stack.py, the dash in its name keeps python from importing it directly
+Usage Example:
+    from dod_stack import LocalStack, StackError
+    result = LocalStack(env_name='dev2', interactive=False).check()
+"""
+import importlib.util
+import os
+import sys
+
+_spec = importlib.util.spec_from_file_location(
+    __name__, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dod-stack.py'))
+_module = importlib.util.module_from_spec(_spec)
+sys.modules[__name__] = _module
+_spec.loader.exec_module(_module)